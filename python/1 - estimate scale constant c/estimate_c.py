@@ -2,33 +2,24 @@
 #                (see equation (2) in main text)
 
 import numpy as np
-import pandas as pd
 from scipy import stats
 import matplotlib.pyplot as plt
-from hdrp import srgb
+from hdrp import srgb, RenderDataset, ScaleEstimator
 
 # load data generated by Unity project model_test with a Lambertian
 # material and no tonemapping
-df = pd.read_csv('data/tonemap_off/data_L1_T0.txt')
+data = RenderDataset.load('data/tonemap_off/data_L1_T0.txt')
 
-# create numpy arrays for model parameters
-e = df['e'].to_numpy().reshape((-1,1))       # exposure
-m = df[['m_r','m_g','m_b']].to_numpy()       # material color
-d = df[['d_r','d_g','d_b']].to_numpy()       # directional light color
-a = df[['a_r','a_g','a_b']].to_numpy()       # ambient light color
-v = df[['v_r','v_g','v_b']].to_numpy()       # post-processed color
-i_d = df['i_d'].to_numpy().reshape((-1,1))   # directional light intensity
-i_a = df['i_a'].to_numpy().reshape((-1,1))   # directional light intensity
-l = df[['l_x','l_y','l_z']].to_numpy()       # lighting direction
-n = df[['n_x','n_y','n_z']].to_numpy()       # plane surface normal
-costheta = (l*n).sum(axis=1, keepdims=True)  # cosine of angle between lighting direction and plane surface normal
+# post-processed color coordinates; a view into the dataset, not a copy
+v = data.v
 
 # apply Lambertian rendering model to get predicted rendered color
 # coordinates u_k, without rendering scale constant c
-u_hat = srgb(m) * ( i_d * srgb(d) * costheta.clip(min=0) / np.pi + i_a * a ) / (2**e)
+u_hat = data.render()
 
 # apply sRGB nonlinearity to get actual rendered color coordinates u_k
-u = srgb(v)
+# (v_k is read back from an 8-bit texture, so we can use a table lookup)
+u = srgb(v, quantized=True)
 
 # discard values outside [ 0, 0.95 ]
 k = (u < 0) | (u > 0.95) | (u_hat < 0) | (u_hat > 0.95)
@@ -48,13 +39,16 @@ plt.xlim(xylim)
 plt.ylim(xylim)
 plt.gca().set_aspect(1)
 
-# find regression slope of a line constrained to pass through the origin
-k = ~np.isnan(u)
-m = np.linalg.lstsq(u[k].reshape((-1,1)), u_hat[k].reshape((-1,1)))[0].item()
+# find regression slope of a line constrained to pass through the origin; the
+# estimator keeps running sums, and ignores the discarded (nan) values. to add
+# more data files without loading them, use est.addlog(fname)
+est = ScaleEstimator()
+est.update(u, u_hat)
+m = est.slope
 
 # the scale constant that will adjust the predicted rendered color coordinates u_k
 # so that they fall on the line y=x is the inverse of the regression slope
-c = 1/m
+c = est.c
 print(f'rendering model scale constant: c = {c:.3f}');
 
 # add regression line to plot
@@ -1,39 +1,27 @@
 # model_test_tonemap_off.py  Test HDRP model predictions without tonemapping
 
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
-from hdrp import srgb, srgbinv
+from hdrp import srgbinv, RenderDataset
 
 # choose whether to test results from Unity project render_random with Lambertian or unlit material
 testLambertian = True
 
 # load data generated by render_random
 fname = f'data/tonemap_off/data_L{int(testLambertian)}_T0.txt'
-df = pd.read_csv(fname)
+data = RenderDataset.load(fname)
 
 # discard samples that may be maxed out
-k = (df[['v_r','v_g','v_b']] <= 0.99).all(axis=1)
-df = df[k]
+data = data.where((data.v <= 0.99).all(axis=1))
 
-# create numpy arrays for model parameters
-e = df['e'].to_numpy().reshape((-1,1))       # exposure
-m = df[['m_r','m_g','m_b']].to_numpy()       # material color
-d = df[['d_r','d_g','d_b']].to_numpy()       # directional light color
-a = df[['a_r','a_g','a_b']].to_numpy()       # ambient light color
-v = df[['v_r','v_g','v_b']].to_numpy()       # post-processed color
-i_d = df['i_d'].to_numpy().reshape((-1,1))   # directional light intensity
-i_a = df['i_a'].to_numpy().reshape((-1,1))   # directional light intensity
-l = df[['l_x','l_y','l_z']].to_numpy()       # lighting direction
-n = df[['n_x','n_y','n_z']].to_numpy()       # plane surface normal
-costheta = (l*n).sum(axis=1, keepdims=True)  # cosine of angle between lighting direction and plane surface normal
+# material and post-processed color coordinates; views into the dataset, not copies
+m, v = data.m, data.v
 
 # apply rendering model to get predictions for unprocessed color coordinates u_k
 if testLambertian:
-    c = 0.822
-    u_hat = c * srgb(m) * ( i_d * srgb(d) * costheta.clip(min=0) / np.pi + i_a * a ) / (2**e)
+    u_hat = data.render(c=0.822)
 else:
-    u_hat = srgb(m)
+    u_hat = data.render(lambertian=False)
 
 # apply inverse sRGB nonlinearity to get post-processed color coordinates v_k
 v_hat = srgbinv(u_hat)
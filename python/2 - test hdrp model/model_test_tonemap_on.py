@@ -1,9 +1,8 @@
 # model_test_tonemap_on.py  Test HDRP model predictions with tonemapping
 
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
-from hdrp import srgb, srgbinv, TonemapCube, cubetag
+from hdrp import srgbinv, TonemapStack, RenderDataset, cubetag
 
 # choose whether to test results from Unity project render_random with Lambertian or unlit material
 testLambertian = True
@@ -12,8 +11,8 @@ testLambertian = True
 cubelist = ['cube/linear_max1.cube', 'cube/square_max1.cube', 'cube/square_root_max1.cube']
 cuben = len(cubelist)
 
-# create tonemapping objects and load tonemaps from cube files
-tonemap = [TonemapCube(f) for f in cubelist]
+# create a stack of tonemapping objects, and load tonemaps from cube files
+tonemap = TonemapStack(cubelist)
 
 # knot points estimated from delta functions (Table 2a)
 #u_knot = [0, 1e-09, 0.0002606, 0.003104, 0.007305, 0.01288, 0.02056, 0.03061, 0.04468, 0.06393, 0.09056, 0.1245, 0.1712, 0.2354, 0.3236, 0.4406, 0.5938, 0.8165, 1.111, 1.498, 2.039, 2.776, 3.78, 5.094, 6.935, 9.441, 12.72, 17.32, 23.35, 31.78, 43.27, 58.9]
@@ -22,45 +21,38 @@ tonemap = [TonemapCube(f) for f in cubelist]
 u_knot = [0, 1e-09, 1.657e-09, 0.002830, 0.007137, 0.01269, 0.02051, 0.03086, 0.04479, 0.06444, 0.08989, 0.1252, 0.1726, 0.2370, 0.3253, 0.4422, 0.6039, 0.8207, 1.104, 1.495, 2.032, 2.756, 3.738, 5.083, 6.864, 9.347, 12.62, 17.18, 23.24, 31.48, 42.75, 57.66]
 
 # assign selected knot points to tonemapping objects
-for t in tonemap:
-    t.u_knot = np.array(u_knot)
+tonemap.u_knot = u_knot
 
 # load data files generated by Unity project render_random
-df = []
+data = []
 for i, cubefile in enumerate(cubelist):
     fname = f'data/tonemap_on_test/data_L{int(testLambertian)}_T1{cubetag(cubefile)}.txt'
-    df2 = pd.read_csv(fname)
-    df2['cubenum'] = i
-    df.append(df2)
-df = pd.concat(df)
+    data.append(RenderDataset.load(fname, cubenum=i))
+data = RenderDataset.concat(data)
 
 # discard samples that may be maxed out
-k = (df[['v_r', 'v_g', 'v_b']] <= 0.99).all(axis=1)
-df = df[k]
+data = data.where((data.v <= 0.99).all(axis=1))
 
 ## optionally discard samples with low material color coordinates
-#k = (df[['m_r', 'm_g', 'm_b']] >= 0.20).all(axis=1)
-#df = df[k]
-
-# create numpy arrays for model parameters
-e = df['e'].to_numpy().reshape((-1, 1))  # exposure
-m = df[['m_r', 'm_g', 'm_b']].to_numpy()  # material color
-d = df[['d_r', 'd_g', 'd_b']].to_numpy()  # directional light color
-a = df[['a_r', 'a_g', 'a_b']].to_numpy()  # ambient light color
-v = df[['v_r', 'v_g', 'v_b']].to_numpy()  # post-processed color
-i_d = df['i_d'].to_numpy().reshape((-1, 1))  # directional light intensity
-i_a = df['i_a'].to_numpy().reshape((-1, 1))  # directional light intensity
-l = df[['l_x', 'l_y', 'l_z']].to_numpy()  # lighting direction
-n = df[['n_x', 'n_y', 'n_z']].to_numpy()  # plane surface normal
-costheta = (l * n).sum(axis=1, keepdims=True)  # cosine of angle between lighting direction and plane surface normal
-cubenum = df['cubenum']  # number of cube file used
+#data = data.where((data.m >= 0.20).all(axis=1))
+
+# post-processed color coordinates; a view into the dataset, not a copy
+v = data.v
+cubenum = data.cubenum  # number of cube file used
 
 # apply Lambertian or unlit rendering model
 if testLambertian:
-    c = 0.822
-    u_hat = c * srgb(m) * (i_d * srgb(d) * costheta.clip(min=0) / np.pi + i_a * a) / (2 ** e)
+    u_hat = data.render(c=0.822)
 else:
-    u_hat = srgb(m)
+    u_hat = data.render(lambertian=False)
+
+# apply tonemapping, using each sample's cube file, and apply post-processing
+t_hat = tonemap.apply(u_hat, cubenum)
+v_hat = srgbinv(t_hat, out=t_hat)
+err = v_hat - v
+
+# samples are sorted by cube file; samples for cube file i are start[i] to start[i+1]-1
+start = np.searchsorted(cubenum, np.arange(cuben+1))
 
 # initialize plot for results
 fig = plt.figure(figsize=(13, 5.5))
@@ -71,28 +63,19 @@ ax2 = fig.add_subplot(1, 2, 2)
 handle1 = 3 * [None, ]
 handle2 = 3 * [None, ]
 colors = ['silver', 'gold', 'steelblue']
-err = []
 for i in range(cuben):
 
-    # get data for this cube file, and apply post-processing
-    k = cubenum == i
-    t_hat = tonemap[i].apply(u_hat[k, :])
-    v_hat = srgbinv(t_hat)
-    vv = v[k, :]
-    err.append(v_hat - vv)
-
     # plot predicted post-processed color coordinates v_k against actual v_k
-    kk = np.random.randint(low=0, high=v_hat.shape[0], size=20)
+    kk = np.random.randint(low=start[i], high=start[i+1], size=20)
     for j in range(3):
-        handle1[i] = ax1.scatter(vv[kk, j], v_hat[kk, j], color=colors[i])
+        handle1[i] = ax1.scatter(v[kk, j], v_hat[kk, j], color=colors[i])
 
     # plot prediction error in v_k against actual v_k
-    kk = np.random.randint(low=0, high=v_hat.shape[0], size=50)
+    kk = np.random.randint(low=start[i], high=start[i+1], size=50)
     for j in range(3):
-        handle2[i] = ax2.scatter(vv[kk, j], v_hat[kk, j] - vv[kk, j], color=colors[i])
+        handle2[i] = ax2.scatter(v[kk, j], err[kk, j], color=colors[i])
 
 # find median absolute error
-err = np.concatenate(err, axis=0)
 mae = np.median(abs(err))
 ax2.text(0.1, -0.018, f'error = {255*mae:.2f} / 255', fontsize=12)
 
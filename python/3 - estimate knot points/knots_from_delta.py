@@ -5,18 +5,33 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
-from hdrp import srgb, srgbinv, TonemapCube, cubetag
+from hdrp import srgb, deltaknots
+from renderlog import readlog
+
+# choose whether to refine the knot points to sub-sample precision, by fitting the
+# triangular response to each delta function. by default (refineKnots = False) the
+# knot points are the samples at the peaks of the responses, as in Table 2a; the
+# refinement is optional, and gives knot points that differ from Table 2a.
+refineKnots = False
 
 # load data from Unity project render_delta
-df = pd.read_csv('data/data_delta.txt')
+df = pd.DataFrame(readlog('data/data_delta.txt'))
 
 # calculate unprocessed color coordinates u_k and tonemapped coordinates t_k
 df['u_k'] = 0.822 * df['i_d'] / np.pi   # use the Lambertian rendering model to find u_k
-df['t_k'] = srgb(df['v_r'])             # use the post-processed values in the red channel to find t_k
+df['t_k'] = srgb(df['v_r'].to_numpy(), quantized=True)  # use the post-processed values in the red channel to find t_k
+
+# find knot points, and the order that sorts the data by cube file and u_k
+u_knot, order = deltaknots(df['delta_m'].to_numpy(), df['u_k'].to_numpy(), df['t_k'].to_numpy(), refine=refineKnots, returnorder=True)
+
+# put the data in that order; rows for delta_m = i are start[i] to start[i+1]-1
+df = df.take(order).reset_index(drop=True)
+n = df['delta_m'].max()
+start = np.searchsorted(df['delta_m'].to_numpy(), np.arange(n+2))
 
 # plot tonemapping results from one cube file (delta_16.cube)
 fig = plt.figure(figsize=(14,10))
-df2 = df[df['delta_m']==16].reset_index()
+df2 = df[start[16]:start[17]]
 ax1 = fig.add_subplot(2,1,1)
 ax1.plot(df2['u_k'], df2['t_k'], 'ro', markersize=3)
 ax1.set_xscale('log')
@@ -26,24 +41,13 @@ ax1.set_xlabel('unprocessed $u_k$', fontsize=18)
 ax1.set_ylabel('tonemapped $t_k$', fontsize=18)
 ax1.text(1.2e-4,0.1,'(a)',fontsize=24)
 
-# plot tonemapping results from all cube files, and find knot points
+# plot tonemapping results from all cube files, and knot points
 ax2 = fig.add_subplot(2,1,2)
 colors = list(mcolors.TABLEAU_COLORS.keys())
-n = max(df['delta_m'])
-u_knot = np.full((n,), np.nan)
 for i in range(3, n+1):
 
-    # find knot point
-    df2 = df[df['delta_m']==i].reset_index()
-    if i==3:
-        j = (df2['t_k'] > 0.99).to_numpy().nonzero()[0][-1]
-    elif i==n:
-        j = (df2['t_k'] == 1).to_numpy().nonzero()[0][0]
-    else:
-        j = (df2['t_k']).to_numpy().argmax()
-    u_knot[i-1] = df2.loc[j,'u_k']
-    
     # plot data from this cube file
+    df2 = df[start[i]:start[i+1]]
     ax2.plot(df2['u_k'], df2['t_k'], 'o', color=colors[i % 10], markersize=3)
     ax2.plot(2*(u_knot[i-1],), (0, 1.1), '-', color='silver')
     ax2.text(0.92*u_knot[i-1], 1.05, f'{i}')
@@ -2,10 +2,8 @@
 
 import os
 import numpy as np
-import pandas as pd
-from scipy import optimize
 import matplotlib.pyplot as plt
-from hdrp import srgb, srgbinv, TonemapCube, cubetag
+from hdrp import srgbinv, TonemapStack, KnotFit, RenderDataset, cubetag
 
 # choose whether to test results from Unity project render_random with Lambertian or unlit material
 testLambertian = True
@@ -18,47 +16,30 @@ cubelists = [['cube/linear_max58.cube', 'cube/square_max58.cube', 'cube/square_r
 # and in the second pass, we'll optimize just knot points for u_k in the range [0, 1]
 for passnum in range(2):
 
-    # get cube filenames for this pass, and load tonemaps from cube files
+    # get cube filenames for this pass, and load a stack of tonemaps from cube files
     cubelist = cubelists[passnum]
-    tonemap = [TonemapCube(f) for f in cubelist]
+    tonemap = TonemapStack(cubelist)
     cuben = len(cubelist)
     
     # load data generated by Unity project render_random
-    df = []
+    data = []
     for i, cubefile in enumerate(cubelist):
         fname = f'data/tonemap_on_fit/data_L{int(testLambertian)}_T1{cubetag(cubefile)}.txt'
-        df2 = pd.read_csv(fname)
-        df2['cubenum'] = i
-        df.append(df2)
-    df = pd.concat(df)
+        data.append(RenderDataset.load(fname, cubenum=i))
+    data = RenderDataset.concat(data)
     
-    # discard samples that may be maxed out
-    k = (df[['v_r','v_g','v_b']] <= 0.99).all(axis=1)
-    df = df[k]
+    # discard samples that may be maxed out, and samples with low material color coordinates
+    data = data.where((data.v <= 0.99).all(axis=1) & (data.m >= 0.20).all(axis=1))
     
-    # discard samples with low material color coordinates
-    k = (df[['m_r','m_g','m_b']] >= 0.20).all(axis=1)
-    df = df[k]
-    
-    # create numpy arrays for model parameters
-    e = df['e'].to_numpy().reshape((-1,1))       # exposure
-    m = df[['m_r','m_g','m_b']].to_numpy()       # material color
-    d = df[['d_r','d_g','d_b']].to_numpy()       # directional light color
-    a = df[['a_r','a_g','a_b']].to_numpy()       # ambient light color
-    v = df[['v_r','v_g','v_b']].to_numpy()       # post-processed color
-    i_d = df['i_d'].to_numpy().reshape((-1,1))   # directional light intensity
-    i_a = df['i_a'].to_numpy().reshape((-1,1))   # directional light intensity
-    l = df[['l_x','l_y','l_z']].to_numpy()       # lighting direction
-    n = df[['n_x','n_y','n_z']].to_numpy()       # plane surface normal
-    costheta = (l*n).sum(axis=1, keepdims=True)  # cosine of angle between lighting direction and plane surface normal
-    cubenum = df['cubenum']                      # number of cube file used
+    # post-processed color coordinates; a view into the dataset, not a copy
+    v = data.v
+    cubenum = data.cubenum  # number of cube file used
     
     # apply Lambertian or unlit rendering model
     if testLambertian:
-        c = 0.822
-        u_hat = c * srgb(m) * ( i_d * srgb(d) * costheta.clip(min=0) / np.pi + i_a * a ) / (2**e)
+        u_hat = data.render(c=0.822)
     else:
-        u_hat = srgb(m)
+        u_hat = data.render(lambertian=False)
 
     # choose range of knot points to optimize on this pass; points i1 to i2
     if passnum == 0:
@@ -68,64 +49,24 @@ for passnum in range(2):
         i1 = 2
         i2 = 17
     
-    # constraint: each knot point is less than the next knot point
-    nknot = (i2-i1)+1
-    A1 = np.identity(nknot) + np.diag((nknot-1)*(-1,), 1)
-    A1 = A1[:-1,:]
-    lb1 = np.full((A1.shape[0],), -np.inf)
-    ub1 = np.zeros((A1.shape[0],))
-    
-    # constraint: first knot point being varied is greater than its lower neighbour
-    A2 = np.zeros((1, nknot))
-    A2[0,0] = 1
-    lb2 = np.array((tonemap[0].u_knot[i1-1],))
-    ub2 = np.array((np.inf,))
-    
-    # constraint: last knot point being varied is less than its higher neighbour
-    A3 = np.zeros((1, nknot))
-    A3[0,-1] = 1
-    lb3 = np.array((-np.inf,))
-    if i2==31:
-        ub3 = np.array((60,))
-    else:
-        ub3 = np.array((tonemap[0].u_knot[i2+1],))
-    
-    # combine constraints
-    A = np.vstack((A1, A2, A3))
-    lb = np.concatenate((lb1, lb2, lb3))
-    ub = np.concatenate((ub1, ub2, ub3))
-    cons = optimize.LinearConstraint(A=A, lb=lb, ub=ub)
-    
-    # define objective function that finds the sum-of-squares difference between
-    # the post-processed coordinates v_k generated by render_random, and the
-    # values v_k predicted by the current tonemapping function
-    def errfn(param):
-    
-        # check that constraints are satisifed
-        # (the tonemapping function throws an exception if they're not)
-        x = A @ param
-        if not ((lb < x) & (x < ub)).all():
-            return np.inf
-        
-        # find prediction error
-        err = 0
-        for i in range(cuben):
-            tonemap[i].u_knot[i1:i2+1] = param
-            k = cubenum == i
-            t_hat = tonemap[i].apply(u_hat[k,:])
-            v_hat = srgbinv(t_hat)
-            err += ((v[k,:]-v_hat)**2).sum()
-        
-        return err
-    
-    # find knot points that optimize prediction accuracy
-    pinit = tonemap[0].u_knot[i1:i2+1]
-    r = optimize.minimize(errfn, pinit, constraints=cons)
+    # find knot points that optimize prediction accuracy, i.e., that minimize the
+    # sum-of-squares difference between the post-processed coordinates v_k generated
+    # by render_random, and the values v_k predicted by the current tonemapping
+    # function; the fit keeps the knot points in increasing order, and assigns
+    # the new points to the stack of tonemapping objects
+    # - if the last knot point is being fitted, it is constrained to be less than 60
+    fit = KnotFit(tonemap, u_hat, v, cubenum, i1, i2, ub=60)
+    r = fit.fit()
     print(r)
-    
-    # assign new points to tonemapping objects
-    for t in tonemap:
-        t.u_knot[i1:i2+1] = r.x
+
+    # apply tonemapping with the new knot points, using each sample's cube file,
+    # and apply post-processing
+    t_hat = tonemap.apply(u_hat, cubenum)
+    v_hat = srgbinv(t_hat, out=t_hat)
+    err = v_hat - v
+
+    # samples are sorted by cube file; samples for cube file i are start[i] to start[i+1]-1
+    start = np.searchsorted(cubenum, np.arange(cuben+1))
 
     # initialize plot for results
     fig = plt.figure(figsize=(13,5.5))
@@ -135,28 +76,19 @@ for passnum in range(2):
     # step through cube files
     handle1 = 3*[None,]
     handle2 = 3*[None,]
-    err = []
-    for i in range(len(cubelist)):
-        
-        # get data for this cube file, and apply post-processing
-        k = cubenum == i
-        t_hat = tonemap[i].apply(u_hat[k,:])
-        v_hat = srgbinv(t_hat)
-        vv = v[k,:]
-        err.append(v_hat-vv)
+    for i in range(cuben):
         
         # plot predicted post-processed color coordinates v_k against actual v_k
-        kk = np.random.randint(low=0, high=v_hat.shape[0], size=20)
+        kk = np.random.randint(low=start[i], high=start[i+1], size=20)
         for j in range(3):
-            handle1[i] = ax1.scatter(vv[kk,j], v_hat[kk,j], color='rgb'[i])
+            handle1[i] = ax1.scatter(v[kk,j], v_hat[kk,j], color='rgb'[i])
         
         # plot prediction error in v_k against actual v_k
-        kk = np.random.randint(low=0, high=v_hat.shape[0], size=50)
+        kk = np.random.randint(low=start[i], high=start[i+1], size=50)
         for j in range(3):
-            handle2[i] = ax2.scatter(vv[kk,j], v_hat[kk,j] - vv[kk,j], color='rgb'[i])
+            handle2[i] = ax2.scatter(v[kk,j], err[kk,j], color='rgb'[i])
 
     # find mean absolute error
-    err = np.concatenate(err, axis=0)
     mae = np.median(abs(err))
     ax2.text(0.1, -0.018, f'error = {255 * mae:.2f} / 255', fontsize=12)
 
@@ -187,4 +119,4 @@ for passnum in range(2):
     plt.show()
 
 # print knot points
-print(np.array2string(tonemap[0].u_knot, formatter={'float' : lambda u : f'{u:.4g}'}, separator=', ', max_line_width=np.inf))
+print(np.array2string(tonemap.u_knot, formatter={'float' : lambda u : f'{u:.4g}'}, separator=', ', max_line_width=np.inf))
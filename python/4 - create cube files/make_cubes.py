@@ -1,8 +1,41 @@
 # make_cubes.py  Make cube files for tonemapping
 
+import os
 import numpy as np
-import matplotlib.pyplot as plt
-from hdrp import TonemapCube
+from concurrent.futures import ProcessPoolExecutor
+import hdrp
+from hdrp import SeparableTonemap
+
+# choose directory for cube files
+cubedir = 'cube'
+
+# choose whether to make cube files for delta functions, which are used in the
+# project render_delta
+makeDelta = True
+
+# choose whether to remake cube files that are already up to date, i.e., that are
+# newer than this script and hdrp.py (which has the knot points)
+remakeAll = False
+
+# choose whether to plot the tonemapping functions, after the cube files are made
+showPlots = False
+
+# number of worker processes; None means one per CPU
+workers = None
+
+# tonemapping functions; each is (name, kind, parameter, scale), and gives outputs
+# at the knot points u_knot as follows
+#     'power':  (u_knot/scale) ** parameter, clipped to 1 after the first output
+#               greater than 1
+#     'delta':  one at knot point number parameter (counting from 1), zero elsewhere
+curves = [('square_max1', 'power', 2, 1),              # maps [0, 1] to [0, 1]
+          ('square_max58', 'power', 2, 58),            # maps [0, 58] to [0, 1]
+          ('square_root_max1', 'power', 0.5, 1),       # maps [0, 1] to [0, 1]
+          ('square_root_max58', 'power', 0.5, 58),     # maps [0, 58] to [0, 1]
+          ('linear_max1', 'power', 1, 1),              # maps [0, 1] to [0, 1]
+          ('linear_max58', 'power', 1, 58)]            # maps [0, 58] to [0, 1]
+if makeDelta:
+    curves += [(f'delta_{m:02d}', 'delta', m, 1) for m in range(1, len(hdrp.Knots)+1)]
 
 def clip(x):
     'set the elements of a 1D array to one, after the first element greater than one'
@@ -11,65 +44,62 @@ def clip(x):
         x[k[1]:] = 1
     return x
 
+def tonecurve(u_knot, kind, parameter, scale):
+    'outputs of a tonemapping function at knot points u_knot'
+    if kind == 'power':
+        return clip((u_knot/scale) ** parameter)
+    if kind == 'delta':
+        t_knot = np.zeros(u_knot.shape)
+        t_knot[parameter-1] = 1
+        return t_knot
+    raise Exception(f'unknown kind of tonemapping function: {kind}')
+
+def cubefile(name):
+    'filename of cube file for a tonemapping function'
+    return f'{cubedir}/{name}.cube'
+
+def uptodate(fname, sources):
+    'whether file fname exists, and is newer than all the source files'
+    if not os.path.exists(fname):
+        return False
+    t = os.path.getmtime(fname)
+    return all(os.path.getmtime(s) <= t for s in sources)
+
+def makecube(curve):
+    'make the cube file for a tonemapping function, and return its filename'
+    name, kind, parameter, scale = curve
+    t = SeparableTonemap()
+    t.setchannels(tonecurve(t.u_knot, kind, parameter, scale))
+    t.save(cubefile(name))
+    return t.filename
+
 def plot_red(t):
     'plot the red channel of a tonemapping table that processes the three color channels independently'
-    plt.plot(t.u_knot, t.cube[:,0,0,0], 'ro-')
+    import matplotlib.pyplot as plt
+    plt.plot(t.u_knot, t.t_knot[:,0], 'ro-')
     plt.xlim((t.u_knot[2], t.u_knot[-1]))
     plt.xscale('log')
     plt.xlabel('unprocessed input $u_r$')
     plt.ylabel('tonemapped output $t_r$')
     plt.title(t.filename)
 
-# create tonemapping object
-t = TonemapCube()
-
-# tonemapping function is square (u_k ** 2); maps [0, 1] to [0, 1]
-t_knot = t.u_knot ** 2
-t_knot = clip(t_knot)
-t.setchannels(t_knot)
-t.save('cube/square_max1.cube')
-plot_red(t) ; plt.show()
-
-# tonemapping function is scaled square ((x/58) ** 2); maps [0, 58] to [0, 1]
-t_knot = (t.u_knot/58) ** 2
-t_knot = clip(t_knot)
-t.setchannels(t_knot)
-t.save('cube/square_max58.cube')
-plot_red(t) ; plt.show()
-
-# tonemapping function is square root (u_k ** 0.5); maps [0, 1] to [0, 1]
-t_knot = t.u_knot ** 0.5
-t_knot = clip(t_knot)
-t.setchannels(t_knot)
-t.save('cube/square_root_max1.cube')
-plot_red(t) ; plt.show()
-
-# tonemapping function is scaled square root((u_k/58) ** 0.5); maps [0, 58] to [0, 1]
-t_knot = (t.u_knot/58) ** 0.5
-t_knot = clip(t_knot)
-t.setchannels(t_knot)
-t.save('cube/square_root_max58.cube')
-plot_red(t) ; plt.show()
-
-# tonemapping is linear; maps [0, 1] to [0, 1]
-t_knot = t.u_knot.copy()
-t_knot = clip(t_knot)
-t.setchannels(t_knot)
-t.save('cube/linear_max1.cube')
-plot_red(t) ; plt.show()
-
-# tonemapping is linear; maps [0, 58] to [0, 1]
-t_knot = t.u_knot/58
-t_knot = clip(t_knot)
-t.setchannels(t_knot)
-t.save('cube/linear_max58.cube')
-plot_red(t) ; plt.show()
-
-# this code generates cube files for delta functions, which are used in the
-# project render_delta; commented out here because we don't usually need
-# these 32 files outside that project
-# for m in range(1, 33):
-#    t_knot = np.zeros(t.u_knot.shape)
-#    t_knot[m-1] = 1
-#    t.setchannels(t_knot)
-#    t.save(f'cube/delta_{m:02d}.cube')
+if __name__ == '__main__':
+
+    # find the cube files that need to be made
+    os.makedirs(cubedir, exist_ok=True)
+    sources = [os.path.abspath(__file__), os.path.abspath(hdrp.__file__)]
+    todo = [c for c in curves if remakeAll or not uptodate(cubefile(c[0]), sources)]
+    print(f'making {len(todo)} of {len(curves)} cube files')
+
+    # make the cube files in parallel
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for fname in pool.map(makecube, todo):
+            print(fname)
+
+    # plot the tonemapping functions, except the delta functions
+    if showPlots:
+        import matplotlib.pyplot as plt
+        for c in curves:
+            if c[1] != 'delta':
+                plot_red(SeparableTonemap(cubefile(c[0])))
+                plt.show()
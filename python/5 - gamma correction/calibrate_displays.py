@@ -0,0 +1,114 @@
+# calibrate_displays.py  Characterize a set of displays and generate a cube file for
+#                        gamma correction for each of them
+
+import os
+
+# each worker process fits one display at a time, and the arrays are small, so
+# multithreaded linear algebra only adds overhead; use one thread per process, so
+# that the processes scale with the number of CPUs. this has to be set before numpy
+# is imported.
+for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+    os.environ.setdefault(var, '1')
+
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from hdrp import CubeLibrary
+from renderlog import cachedir
+from charfit import CharLum, CharXYZ
+
+# choose directory with characterization measurements; it has a subdirectory for
+# each display, with the measurements made with tonemapping off, in the same format
+# as data/characterize, e.g.,
+#     data/displays/lab1/data_achromatic_T0.txt
+#     data/displays/lab1/data_chromatic_T0.txt
+#     data/displays/lab2/data_achromatic_T0.txt
+# a display can have either file, or both
+displaydir = 'data/displays'
+
+# choose directory for cube files; the cube files for each display are saved in a
+# subdirectory with the same name as in displaydir, e.g.,
+#     cube/displays/lab1/linearize_achromatic.cube
+cubedir = 'cube/displays'
+
+# number of worker processes; None means one per CPU
+workers = None
+
+# kinds of characterization; each is (kind, data filename, characterization class)
+kinds = [('achromatic', 'data_achromatic_T0.txt', CharLum),
+         ('chromatic', 'data_chromatic_T0.txt', CharXYZ)]
+
+def findjobs(displaydir):
+    'list of (display, kind, data filename) for all measurement files in displaydir'
+    jobs = []
+    for display in sorted(os.listdir(displaydir)):
+        for kind, fname, _ in kinds:
+            datafile = os.path.join(displaydir, display, fname)
+            if os.path.isfile(datafile):
+                jobs.append((display, kind, datafile))
+    return jobs
+
+def readdata(kind, datafile):
+    'read post-processed values v_k and measurements (luminance or xyz) from a data file'
+    df = pd.read_csv(datafile)
+    if kind == 'achromatic':
+        return df['m_k'].to_numpy(), df['lum'].to_numpy()
+    return df[['m_r', 'm_g', 'm_b']].to_numpy(), df[['x', 'y', 'z']].to_numpy()
+
+def calibrate(job):
+    'fit a characterization model to the measurements from one display, and save the cube file for gamma correction; return a summary'
+    display, kind, datafile = job
+    cls = {k: c for k, _, c in kinds}[kind]
+    t0 = time.perf_counter()
+
+    # fit the characterization model; see char_achromatic_1.py and char_chromatic_1.py.
+    # as in those scripts, the fitted model and the tonemapping object are saved in the
+    # cache directory of the data file, and are only remade when the measurements, the
+    # fitted model, or the version of the code that makes them change.
+    v, data = readdata(kind, datafile)
+    char = cls.fitcached(datafile, v, data)
+    t1 = time.perf_counter()
+
+    # make the tonemapping object, and save the cube file
+    lib = CubeLibrary.open(os.path.join(cachedir(datafile), 'tonemaps.lib'))
+    tonemap = lib.fetch(f'linearize_{kind}', char.tonemapkey(), char.linearize)
+    os.makedirs(os.path.join(cubedir, display), exist_ok=True)
+    cubefile = os.path.join(cubedir, display, f'linearize_{kind}.cube')
+    tonemap.save(cubefile)
+    t2 = time.perf_counter()
+
+    # accuracy of the characterization model, as the RMS error of the fit, in percent
+    # of the largest measurement, and accuracy of the tonemapping object, as the
+    # largest difference from the tonemapping function it approximates, over the
+    # displayable range of u_k
+    pred = char.v2lum(v) if kind == 'achromatic' else char.v2xyz(v)
+    fiterr = 100 * np.sqrt(np.mean((pred - data) ** 2)) / np.max(data)
+    uu = np.linspace(1/255, 1, 1000)
+    t_k = tonemap.apply(np.column_stack([uu, uu, uu]))
+    toneerr = np.max(np.abs(t_k - char.correction(uu).reshape(len(uu), -1)))
+
+    return {'display': display, 'kind': kind, 'n': len(data), 'fit_s': t1 - t0, 'tonemap_s': t2 - t1,
+            'fit_rms_pct': fiterr, 'tonemap_max_err': toneerr, 'cube': cubefile}
+
+if __name__ == '__main__':
+
+    jobs = findjobs(displaydir)
+    if not jobs:
+        raise Exception(f'no measurement files found in {displaydir}')
+    n = len({job[0] for job in jobs})
+    print(f'calibrating {n} displays ({len(jobs)} measurement files)')
+
+    # calibrate the displays in parallel; each measurement file is a separate job
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        summary = pd.DataFrame(pool.map(calibrate, jobs))
+    elapsed = time.perf_counter() - start
+
+    # print and save the summary
+    os.makedirs(cubedir, exist_ok=True)
+    summary.to_csv(os.path.join(cubedir, 'summary.csv'), index=False)
+    with pd.option_context('display.width', 200, 'display.max_rows', None):
+        print(summary.drop(columns='cube').to_string(index=False, float_format='%.4g'))
+    busy = (summary['fit_s'] + summary['tonemap_s']).sum()
+    print(f'total time {elapsed:.2f} s; time in jobs {busy:.2f} s; worst fit RMS error {summary["fit_rms_pct"].max():.3g}%; worst tonemap error {summary["tonemap_max_err"].max():.3g}')
@@ -1,23 +1,26 @@
 # char_achromatic_1.py  Characterize achromatic stimulus display and generate a cube file
 #                       for gamma correction
 
+import os
 import numpy as np
 import pandas as pd
-from scipy import optimize
 import matplotlib.pyplot as plt
-from hdrp import srgb, srgbinv, TonemapCube
+from hdrp import srgb, srgbinv, CubeLibrary
+from renderlog import cachedir
 from charfit import CharLum
 
 # load luminance characterization measurements, made with tonemapping off
-df = pd.read_csv('data/characterize/data_achromatic_T0.txt')
+datafile = 'data/characterize/data_achromatic_T0.txt'
+df = pd.read_csv(datafile)
 m_k = df['m_k'].to_numpy()
 lum = df['lum'].to_numpy()
 u_k = srgb(m_k)
 v_k = m_k
 
 # fit a characterization model to luminance vs. v_k
-char = CharLum(v=v_k, lum=lum)
-char.fit()
+# - the fitted model is saved in the cache directory of the data file, and is loaded
+#   from there instead of refitted, as long as the measurements haven't changed
+char = CharLum.fitcached(datafile, v_k, lum)
 
 # plot luminance vs. unprocessed values u_k
 # - the CharLum class has a method plot() that plots luminance vs.
@@ -37,43 +40,14 @@ plt.ylabel('luminance (cd/m$^2$)', fontsize=18)
 plt.savefig('figures/char_achromatic_1.pdf');
 plt.show()
 
-# define the tonemapping function for gamma correction; see equation (15)
-# - here we implicitly set r = 1, so the displayable range of u_k is [0, 1]
-# - clipping of the input to hinv to a lower bound of zero is done by hinv itself,
-#   so we don't need an explicit max(x, 0) as in equation (15)
-def f(u_k):
-    w = char.L0/char.L1
-    return srgb(char.hinv((1+w)*u_k - w, maxout=False), maxout=False)
-    # in order for tonemapping to work for u_k over the full range [0, 1],
-    # we need to set the output value, at the first knot point u_knot that is
-    # greater than one, to a value greater than one. normally the functions
-    # srgb and hinv clip their inputs to [0, 1], so here we pass the optional
-    # argument maxout=False, so that instead they clip their inputs to [0, np.inf]
-
-# create a tonemapping object by applying the tonemapping function f to the knot points
-tonemap = TonemapCube()
-t_knot = f(tonemap.u_knot)
-k1 = (tonemap.u_knot<(1/255)).nonzero()[0][-1]  # first knot point in u_knot below 1/255
-k2 = (tonemap.u_knot>1).nonzero()[0][0]         # first knot point in u_knot above 1
-t_knot[(k2+1):] = 1
-tonemap.setchannels(t_knot)
-
-# we can make the tonemapping object's approxmation to f a bit better by optimizing t_knot
-# - step 1. create an objective function that finds the sum-of-squares error between f and
-#   the approximation from the tonemapping object
-uu = np.linspace(0,1,100)
-fuu = f(uu)
-uu3 = np.column_stack((uu,uu,uu))
-def errfn(param):
-    t_knot[k1:k2+1] = param
-    tonemap.setchannels(t_knot)
-    vv = tonemap.apply(uu3)
-    return ((vv[:,0]-fuu)**2).sum()
-# - step 2. find the values at knot points that minimize the objective function
-pinit = t_knot[k1:k2+1]
-r = optimize.minimize(errfn, pinit)
-t_knot[k1:k2+1] = r.x
-tonemap.setchannels(t_knot)
+# make a tonemapping object for gamma correction
+# - char.correction(u_k) is the tonemapping function for gamma correction in equation (15),
+#   and char.linearize() makes a tonemapping object that approximates it; see charfit.py
+# the tonemapping object is kept in a cube library in the cache directory of the data
+# file, along with a hash of the fitted model, the knot points, and the version of the
+# code that makes it (see CharLum.tonemapkey()), and is only rebuilt when these change
+lib = CubeLibrary.open(os.path.join(cachedir(datafile), 'tonemaps.lib'))
+tonemap = lib.fetch('linearize_achromatic', char.tonemapkey(), char.linearize)
 
 # save the cube file
 tonemap.save('cube/linearize_achromatic.cube')
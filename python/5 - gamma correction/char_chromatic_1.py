@@ -1,22 +1,25 @@
 # char_chromatic_1.py  Characterize chromatic stimulus display and generate a cube file
 #                      for gamma correction
 
+import os
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from scipy import optimize
-from hdrp import srgb, srgbinv, TonemapCube
+from hdrp import srgb, srgbinv, CubeLibrary
+from renderlog import cachedir
 from charfit import CharXYZ
 
 # load color characterization measurements, made with tonemapping off
-df = pd.read_csv('data/characterize/data_chromatic_T0.txt')
+datafile = 'data/characterize/data_chromatic_T0.txt'
+df = pd.read_csv(datafile)
 m = df[['m_r', 'm_g', 'm_b']].to_numpy()
 xyz = df[['x', 'y', 'z']].to_numpy()
 v = m
 
 # fit a characterization model to xyz vs. v
-char = CharXYZ(v=v, xyz=xyz)
-char.fit()
+# - the fitted model is saved in the cache directory of the data file, and is loaded
+#   from there instead of refitted, as long as the measurements haven't changed
+char = CharXYZ.fitcached(datafile, v, xyz)
 
 # express the background term as a weighted sum of the primaries; solve z = w @ rgb for w
 w = (char.z @ np.linalg.inv(char.rgb)).reshape((1, 3))
@@ -44,38 +47,20 @@ plt.legend(labels=['red','green','blue'], frameon=False)
 plt.savefig('figures/char_chromatic_1.pdf');
 plt.show()
 
-# define tonemapping function for gamma correction; see equation (24);
-# also see comments on definition of f(u_k) in char_achromatic_1.py, which
-# apply to this definition as well
-def f_k(u_k, k):
-    return srgb(char.hinv((1+w[0,k])*u_k - w[0,k], k=k, maxout=False), maxout=False)
-
-# create a tonemapping object by applying the tonemapping function f_k to the knot points
-tonemap = TonemapCube()
-t_knot = [f_k(tonemap.u_knot, k) for k in range(3)]
-t_knot = np.column_stack(t_knot)
-k1 = (tonemap.u_knot<(1/255)).nonzero()[0][-1]  # first knot point in u_knot below 1/255
-k2 = (tonemap.u_knot>1).nonzero()[0][0]         # first knot point in u_knot above 1
-t_knot[(k2+1):,:] = 1
-tonemap.setchannels(t_knot)
-
-# we can make the tonemapping object's approxmation to f_k a bit better by optimizing t_knot
-# - step 1. create an objective function that finds the sum-of-squares error between f_k and
-#   the approximation from the tonemapping object
-uu = np.linspace(0,1,100)
-fuu = [f_k(uu, k) for k in range(3)]
-fuu = np.column_stack(fuu)
-uu3 = np.column_stack((uu,uu,uu))
-def errfn(param):
-    t_knot[k1:k2+1,:] = param.reshape((-1,3))
-    tonemap.setchannels(t_knot)
-    vv = tonemap.apply(uu3)
-    return ((vv-fuu)**2).sum()
-# - step 2. find the values at knot points that minimize the objective function
-pinit = t_knot[k1:k2+1,:].flatten()
-r = optimize.minimize(errfn, pinit)
-t_knot[k1:k2+1,:] = r.x.reshape((-1,3))
-tonemap.setchannels(t_knot)
+# make a tonemapping object for gamma correction
+# - char.correction(u_k) is the tonemapping function for gamma correction in equation (24),
+#   and char.linearize() makes a tonemapping object that approximates it; see charfit.py
+# the tonemapping object is kept in a cube library in the cache directory of the data
+# file, along with a hash of the fitted model, the knot points, and the version of the
+# code that makes it (see CharXYZ.tonemapkey()), and is only rebuilt when these change
+lib = CubeLibrary.open(os.path.join(cachedir(datafile), 'tonemaps.lib'))
+tonemap = lib.fetch('linearize_chromatic', char.tonemapkey(), char.linearize)
 
 # save the cube file
+# - the copy of linearize_chromatic.cube in '4 - create cube files/cube files' is the
+#   one made for the paper, with the earlier fit of the characterization model. the
+#   least-squares fit in CharXYZ.fit2() finds a different optimum of the same objective
+#   (about 4% lower sum-of-squares error on data_chromatic_T0.txt), so the cube file made
+#   here differs from the published one by up to 0.055 in some knot values; we keep the
+#   published file as it is
 tonemap.save('cube/linearize_chromatic.cube')
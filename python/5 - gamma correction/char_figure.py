@@ -12,15 +12,16 @@ from charfit import CharLum, CharXYZ
 # 1a. achromatic characterization, with tonemapping off
 
 # load luminance measurements
-df = pd.read_csv('data/characterize/data_achromatic_T0.txt')
+datafile = 'data/characterize/data_achromatic_T0.txt'
+df = pd.read_csv(datafile)
 m_k = df['m_k'].to_numpy()
 lum = df['lum'].to_numpy()
 u_k = srgb(m_k)
 v_k = m_k
 
-# fit a characterization model to luminance vs. v_k
-char = CharLum(v=v_k, lum=lum)
-char.fit()
+# fit a characterization model to luminance vs. v_k, or load the model saved
+# by char_achromatic_1.py, if the measurements haven't changed
+char = CharLum.fitcached(datafile, v_k, lum)
 
 # plot luminance vs. unprocessed values u_k
 # - the CharLum class has a method plot() that plots luminance vs.
@@ -64,14 +65,15 @@ ax1.text(0.85,15,'(a)',fontsize=24)
 # 2a. chromatic characterization, with tonemapping off
 
 # load xyz measurements
-df = pd.read_csv('data/characterize/data_chromatic_T0.txt')
+datafile = 'data/characterize/data_chromatic_T0.txt'
+df = pd.read_csv(datafile)
 m = df[['m_r', 'm_g', 'm_b']].to_numpy()
 xyz = df[['x', 'y', 'z']].to_numpy()
 v = m
 
-# fit a characterization model to xyz vs. v
-char = CharXYZ(v=v, xyz=xyz)
-char.fit()
+# fit a characterization model to xyz vs. v, or load the saved model, if the
+# measurements haven't changed
+char = CharXYZ.fitcached(datafile, v, xyz)
 
 # express the background term as a weighted sum of the primaries; solve z = w @ rgb for w
 w = (char.z @ np.linalg.inv(char.rgb)).reshape((1, 3))
@@ -91,15 +93,16 @@ for k in range(3):
 # 2b. chromatic characterization, with tonemapping on
 
 # load color characterization measurements, made with tonemapping on
-df = pd.read_csv('data/characterize/data_chromatic_T1.txt')
+datafile = 'data/characterize/data_chromatic_T1.txt'
+df = pd.read_csv(datafile)
 m = df[['m_r', 'm_g', 'm_b']].to_numpy()
 xyz = df[['x', 'y', 'z']].to_numpy()
 u = srgb(m)
 v = m
 
-# fit a characterization model to xyz vs. v
-char = CharXYZ(v=v, xyz=xyz)
-char.fit()
+# fit a characterization model to xyz vs. v, or load the saved model, if the
+# measurements haven't changed
+char = CharXYZ.fitcached(datafile, v, xyz)
 
 # find the primary coefficients; solve xyz = coef @ rgb for coef
 coef = char.xyz @ np.linalg.inv(char.rgb)
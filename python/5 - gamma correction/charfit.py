@@ -1,10 +1,240 @@
+import os
+import json
+import hashlib
 import numpy as np
-from scipy import optimize
-from scipy.stats import linregress
-import matplotlib.pyplot as plt
+from renderlog import cachedir
+from hdrp import Knots, srgb, SeparableTonemap
+
+# scipy.optimize and matplotlib are imported in the methods that use them, so that
+# importing this module is fast, and doesn't need a plotting backend
+
+def _lummodel(p, v):
+    'luminance model L0 + L1 * h(v; v0, gamma) and its Jacobian, for P x 4 parameters p (L0, L1, v0, gamma) and P x m values v'
+    L0, L1, v0, gamma = [p[:,i:i+1] for i in range(4)]
+    x = (v.clip(v0, 1) - v0) / (1 - v0)
+    h = x ** gamma
+    inside = x > 0
+    J = np.empty(v.shape + (4,))
+    J[...,0] = 1
+    J[...,1] = h
+    # dh/dv0 = gamma * x**(gamma-1) * dx/dv0, where dx/dv0 = (v-1)/(1-v0)**2 for v0 < v < 1
+    dxdv0 = np.where(inside & (v < 1), (v-1) / (1-v0)**2, 0)
+    J[...,2] = L1 * gamma * np.divide(h, x, out=np.zeros(x.shape), where=inside) * dxdv0
+    J[...,3] = L1 * h * np.log(x, out=np.zeros(x.shape), where=inside)
+    return L0 + L1*h, J
+
+def fitlum(v, lum, starts=((0, 3),), maxiter=200, tol=1e-12):
+    'fit the luminance characterization model L0 + L1 * h(v; v0, gamma) to measurements from N displays at once; v and lum are N x m arrays (or v is a 1D array shared by all displays), with nan for missing measurements; returns an N x 4 array of parameters (L0, L1, v0, gamma), and the sum of squared errors for each display'
+
+    # the fits for all displays, and all starting points, are made together by
+    # Levenberg-Marquardt iterations with an analytic Jacobian; each iteration
+    # solves a batch of 4 x 4 linear systems, one per fit, and each fit has its
+    # own damping parameter. v0 is kept in [0, 0.99], and gamma is kept positive.
+    # starts is a list of initial values of (v0, gamma); the initial values of L0
+    # and L1 come from the minimum and range of the measurements, and for each
+    # display we keep the fit from the start with the smallest error.
+    lum = np.atleast_2d(np.asarray(lum, dtype=float))
+    v = np.broadcast_to(np.asarray(v, dtype=float), lum.shape)
+    valid = np.isfinite(lum) & np.isfinite(v)
+    n = lum.shape[0]
+    starts = np.asarray(starts, dtype=float).reshape((-1,2))
+    s = starts.shape[0]
+
+    # one fit for each start and display
+    lo = np.nanmin(lum, axis=1)
+    hi = np.nanmax(lum, axis=1)
+    p = np.empty((s, n, 4))
+    p[...,0] = lo
+    p[...,1] = hi - lo
+    p[...,2] = starts[:,0:1]
+    p[...,3] = starts[:,1:2]
+    p = p.reshape((-1,4))
+    v = np.tile(np.where(valid, v, 0), (s,1))
+    lum = np.tile(np.where(valid, lum, 0), (s,1))
+    valid = np.tile(valid, (s,1))
+
+    def evaluate(p, k):
+        'residuals, Jacobian, and sum of squared errors for parameters p of fits k'
+        f, J = _lummodel(p, v[k])
+        r = np.where(valid[k], f - lum[k], 0)
+        J *= valid[k,:,np.newaxis]
+        return r, J, (r**2).sum(axis=1)
+
+    k = np.arange(p.shape[0])
+    r, J, sse = evaluate(p, k)
+    lam = np.full(p.shape[0], 1e-3)
+    active = np.ones(p.shape[0], dtype=bool)
+    for _ in range(maxiter):
+
+        # damped Gauss-Newton step for each fit that hasn't converged
+        k = active.nonzero()[0]
+        if k.size == 0:
+            break
+        A = np.einsum('pmi,pmj->pij', J[k], J[k])
+        g = np.einsum('pmi,pm->pi', J[k], r[k])
+        D = np.diagonal(A, axis1=1, axis2=2).clip(min=1e-12)
+        M = A + (lam[k,np.newaxis] * D)[:,:,np.newaxis] * np.eye(4)
+
+        # if v0 is at a bound, and the step would take it past the bound, hold it fixed
+        fixed = ((p[k,2] <= 0) & (g[:,2] > 0)) | ((p[k,2] >= 0.99) & (g[:,2] < 0))
+        M[fixed,2,:] = 0
+        M[fixed,:,2] = 0
+        M[fixed,2,2] = 1
+        g[fixed,2] = 0
+
+        q = p[k] - np.linalg.solve(M, g[...,np.newaxis])[...,0]
+        q[:,2] = q[:,2].clip(0, 0.99)
+        q[:,3] = q[:,3].clip(min=1e-3)
+
+        # accept steps that reduce the error, and adjust the damping
+        rq, Jq, sseq = evaluate(q, k)
+        better = sseq < sse[k]
+        converged = better & (sse[k] - sseq <= tol * sse[k])
+        kb = k[better]
+        p[kb] = q[better]
+        r[kb] = rq[better]
+        J[kb] = Jq[better]
+        sse[kb] = sseq[better]
+        lam[k] = np.where(better, lam[k]/3, lam[k]*4)
+        active[k[converged]] = False
+        active &= (lam < 1e12) & (sse > 0)
+
+    # keep the best fit for each display
+    p = p.reshape((s, n, 4))
+    sse = sse.reshape((s, n))
+    best = sse.argmin(axis=0)
+    return p[best, np.arange(n)], sse[best, np.arange(n)]
+
+def _convert(convert, x, out, dtype, chunksize):
+    'apply a color conversion convert(x, out) to an array x whose last dimension has three channels, in chunks; convert() may overwrite x, which is a temporary copy of each chunk'
+    x = np.asarray(x)
+    if x.shape[-1] != 3:
+        raise Exception('last dimension of array must have three channels')
+    if out is None:
+        out = np.empty(x.shape, dtype=np.result_type(x.dtype, np.float32) if dtype is None else dtype)
+    if out.shape != x.shape or not out.flags.c_contiguous:
+        raise Exception('out must be a contiguous array the same shape as the input')
+    x = x.reshape((-1,3))
+    result = out.reshape((-1,3))
+    buffer = np.empty((min(chunksize, x.shape[0]), 3), dtype=out.dtype)
+    for j1 in range(0, x.shape[0], chunksize):
+        j2 = min(j1 + chunksize, x.shape[0])
+        b = buffer[:j2-j1]
+        b[...] = x[j1:j2]
+        convert(b, result[j1:j2])
+    return out
+
+def datahash(*arrays, tag=''):
+    'SHA-1 hash of arrays of measurements, and an optional string tag (e.g., a version)'
+    h = hashlib.sha1()
+    h.update(tag.encode('utf-8'))
+    for a in arrays:
+        a = np.ascontiguousarray(a, dtype=float)
+        h.update(str(a.shape).encode('utf-8'))
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+# version of _linearize(); increase it when _linearize() changes, so that tonemaps
+# saved by earlier versions are made again (see _Char.tonemapkey())
+_linearizeversion = 1
+
+def _linearize(f):
+    'tonemapping object that approximates the gamma-correction tonemapping function f, which returns one or three channels'
+
+    # create a tonemapping object by applying the tonemapping function f to the knot points
+    tonemap = SeparableTonemap()
+    t_knot = f(tonemap.u_knot)
+    k1 = (tonemap.u_knot<(1/255)).nonzero()[0][-1]  # first knot point in u_knot below 1/255
+    k2 = (tonemap.u_knot>1).nonzero()[0][0]         # first knot point in u_knot above 1
+    t_knot[(k2+1):] = 1
+    tonemap.setchannels(t_knot)
+
+    # we can make the tonemapping object's approxmation to f a bit better by optimizing t_knot
+    # - the approximation is linear in t_knot, so we find the values at knot points k1 to k2
+    #   that minimize the sum-of-squares error between f and the approximation directly, by
+    #   linear least squares; the other knot points keep the values assigned above
+    # - a few of the lowest knot points have only one or two samples of uu between them, so we
+    #   constrain the values to increase from one knot point to the next, which keeps the fit
+    #   from oscillating there
+    uu = np.linspace(0,1,100)
+    tonemap.fit(uu, f(uu), free=slice(k1, k2+1), monotone=True)
+    return tonemap
+
+# base class for characterization models; fitted models can be saved and loaded
+# as small JSON files, along with the measurements and a hash of them, and fitcached()
+# uses these files so that each set of measurements is fitted only once. _data and
+# _params are the names of the attributes with the measurements and the parameters.
+# _version is the version of the model and its fit; increase it when fit() changes,
+# so that models saved by earlier versions are fitted again.
+class _Char:
+
+    _data = ()
+    _params = ()
+    _version = 1
+
+    def key(self):
+        'hash of the measurements, and the class and version of the model'
+        return datahash(*[getattr(self, name) for name in self._data], tag=f'{type(self).__name__} {self._version}')
+
+    def tonemapkey(self):
+        'hash of the fitted parameters, the knot points, and the version of linearize(); tonemaps made by linearize() can be saved with this key'
+        return datahash(*[np.asarray(getattr(self, name), dtype=float) for name in self._params], Knots, tag=f'linearize {_linearizeversion}')
+
+    def save(self, fname):
+        'save measurements and fitted parameters'
+        state = {'class': type(self).__name__, 'version': self._version, 'hash': self.key()}
+        for name in self._data + self._params:
+            state[name] = np.asarray(getattr(self, name), dtype=float).tolist()
+        tmpname = fname + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmpname, fname)
+
+    @classmethod
+    def load(cls, fname):
+        'load measurements and fitted parameters saved by save()'
+        with open(fname, 'r') as f:
+            state = json.load(f)
+        if state.get('class') != cls.__name__:
+            raise ValueError(f'file does not have a saved {cls.__name__} model')
+        if state.get('version') != cls._version:
+            raise ValueError(f'file has a {cls.__name__} model saved by a different version')
+        char = cls(*[np.array(state[name]) for name in cls._data])
+        for name in cls._params:
+            value = state[name]
+            # matrices are stored as nested lists; scalars and lists of channel
+            # parameters are restored as they were
+            if isinstance(value, list) and value and isinstance(value[0], list):
+                value = np.array(value)
+            setattr(char, name, value)
+        return char
+
+    @classmethod
+    def fitcached(cls, fname, *data):
+        'fit model to measurements data (e.g., v and lum) read from file fname; if the same measurements have been fitted before by the same version of the model, load the saved model from the cache directory of fname instead'
+        char = cls(*data)
+        cachename = os.path.join(cachedir(fname), cls.__name__ + '.json')
+        # a missing, damaged, or out-of-date file means the model is fitted again
+        try:
+            saved = cls.load(cachename)
+            if saved.key() == char.key():
+                return saved
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        char.fit()
+        os.makedirs(cachedir(fname), exist_ok=True)
+        char.save(cachename)
+        return char
+
+    def linearize(self):
+        'tonemapping object for gamma correction, from the fitted model; see correction()'
+        return _linearize(self.correction)
 
 # class for luminance characterization
-class CharLum:
+class CharLum(_Char):
+
+    _data = ('v', 'lum')
+    _params = ('L0', 'L1', 'v0', 'gamma')
 
     def __init__(self, v=None, lum=None):
 
@@ -18,25 +248,27 @@ class CharLum:
         self.v0 = None      # v_k cutoff
         self.gamma = None   # gamma function exponent
 
-    def fit(self):
-        'fit characterization model'
-
-        # define sum-of-squares objective function
-        def errfn(param):
-            return ((self.lum - self.v2lum(self.v, *param)) ** 2).sum()
-
-        # make initial estimates of parameters
-        k = self.v > 0.1
-        pinit = np.array((min(self.lum), max(self.lum) - min(self.lum), 0, 3))
-
-        # optimize fit
-        # cons = optimize.LinearConstraint(A=np.array([[0, 0, 1, 0]]), lb=0)  # constrain v0 >= 0
-        cons = optimize.LinearConstraint(np.array((0, 0, 1, 0)).reshape((1, 4)), np.array((0,)))  # constrain v0 >= 0
-        r = optimize.minimize(errfn, pinit, constraints=cons)
-        self.L0, self.L1, self.v0, self.gamma = r.x
+    def fit(self, starts=((0, 3),)):
+        'fit characterization model; see fitlum()'
+        p, _ = fitlum(self.v, self.lum, starts=starts)
+        self.L0, self.L1, self.v0, self.gamma = p[0]
+
+    @classmethod
+    def fitmany(cls, v, lum, starts=((0, 3),)):
+        'fit characterization models to measurements from N displays at once, and return a list of N fitted objects; see fitlum()'
+        lum = np.atleast_2d(lum)
+        v = np.broadcast_to(v, lum.shape)
+        p, _ = fitlum(v, lum, starts=starts)
+        chars = []
+        for i in range(lum.shape[0]):
+            char = cls(v=v[i], lum=lum[i])
+            char.L0, char.L1, char.v0, char.gamma = p[i]
+            chars.append(char)
+        return chars
 
     def plot(self):
         'plot characterization measurements and model fit'
+        import matplotlib.pyplot as plt
         vv = np.linspace(0, 1, 100)
         plt.plot(vv, self.v2lum(vv), 'k-')
         plt.plot(self.v, self.lum, 'ro', markersize=10)
@@ -62,6 +294,19 @@ class CharLum:
         p = (lum-L0)/L1
         return self.hinv(p, v0=v0, gamma=gamma)
 
+    def correction(self, u_k):
+        'tonemapping function for gamma correction; see equation (15)'
+        # - here we implicitly set r = 1, so the displayable range of u_k is [0, 1]
+        # - clipping of the input to hinv to a lower bound of zero is done by hinv itself,
+        #   so we don't need an explicit max(x, 0) as in equation (15)
+        # - in order for tonemapping to work for u_k over the full range [0, 1], we need
+        #   to set the output value, at the first knot point u_knot that is greater than
+        #   one, to a value greater than one. normally the functions srgb and hinv clip
+        #   their inputs to [0, 1], so here we pass the optional argument maxout=False,
+        #   so that instead they clip their inputs to [0, np.inf]
+        w = self.L0/self.L1
+        return srgb(self.hinv((1+w)*u_k - w, maxout=False), maxout=False)
+
     def h(self, v, v0=None, gamma=None, maxout=True):
         'activation function with parameters v0, gamma; maxout determines whether maximum value is 1.0'
         if v0 is None: v0 = self.v0
@@ -79,7 +324,10 @@ class CharLum:
         return v0 + (1-v0)*(p ** (1/gamma))
 
 # class for color characterization
-class CharXYZ:
+class CharXYZ(_Char):
+
+    _data = ('v', 'xyz')
+    _params = ('rgb', 'z', 'v0', 'gamma')
 
     def __init__(self, v=None, xyz=None):
 
@@ -93,6 +341,13 @@ class CharXYZ:
         self.v0 = [None, None, None]      # v_k cutoffs for each channel
         self.gamma = [None, None, None]   # gamma exponent for each channel
 
+        # most recent parameter vector in the global fit, and residuals and Jacobian found from it
+        self._vec = None
+
+        # inverse of self.rgb, and the primaries it was found from; see rgbinv()
+        self._rgbinv = None
+        self._rgbkey = None
+
     def fit(self):
         'fit model to characterization measurements'
         self.fit1()  # first pass at model fit
@@ -100,6 +355,7 @@ class CharXYZ:
 
     def fit1(self):
         'first pass at model fit'
+        from scipy import optimize
 
         # estimate the primaries and background term
         def lookup(row):
@@ -125,40 +381,74 @@ class CharXYZ:
             self.v0[k], self.gamma[k] = r.x
 
     def fit2(self):
-        'fine-tune model fit by making a global fit'
-
-        def param2vec(rgb, z, v0, gamma):
-            'convert parameters to a single 1D vector'
-            return np.hstack((rgb.flatten(), z.flatten(), np.array(v0), np.array(gamma)))
-
-        def vec2param(v):
-            'convert 1D vector back to parameters'
-            return v[0:9].reshape((3,3)), v[9:12].reshape((1,3)), v[12:15].tolist(), v[15:18].tolist()
-
-        def errfn(vec):
-            'find error in fit of model to characterization measurements, for parameters in 1D vector vec'
-            rgb, z, v0, gamma = vec2param(vec)
-            p = (self.xyz - z) @ np.linalg.inv(rgb)  # find the activations; solve xyz = p @ rgb + z for p
-            err = 0
-            for k in range(3):
-                phat = self.h(self.v[:,k], v0=v0[k], gamma=gamma[k])
-                err += ((p[:,k]-phat)**2).sum()
-            return err
-
-        # make 1D vector with current parameter estimates
-        pinit = param2vec(self.rgb, self.z, self.v0, self.gamma)
-        
-        # define constraints v0 >= 0
-        A = np.zeros((3, pinit.size))
-        A[(0,1,2),(12,13,14)] = 1
-        cons = optimize.LinearConstraint(A=A, lb=0, ub=np.inf)
-        
-        # optimize fit
-        r = optimize.minimize(errfn, pinit, constraints=cons)
-        self.rgb, self.z, self.v0, self.gamma = vec2param(r.x)
+        'fine-tune model fit by making a global least-squares fit, starting from the current parameters (e.g., from fit1)'
+        from scipy.optimize import least_squares
+
+        # the residuals are the differences between the activations found from the
+        # XYZ measurements, and the activations predicted from v_k, for all
+        # measurements and channels; see residuals() and jacobian()
+        x0 = self._param2vec(self.rgb, self.z, self.v0, self.gamma)
+        lb = np.full(x0.size, -np.inf)
+        ub = np.full(x0.size, np.inf)
+        lb[12:15], ub[12:15] = 0, 0.99      # constrain 0 <= v0 <= 0.99
+        lb[15:18] = 1e-3                    # constrain gamma > 0
+        x0 = x0.clip(lb, ub)
+        r = least_squares(self.residuals, x0, jac=self.jacobian, bounds=(lb, ub), x_scale='jac')
+        self.rgb, self.z, self.v0, self.gamma = self._vec2param(r.x)
+        return r
+
+    @staticmethod
+    def _param2vec(rgb, z, v0, gamma):
+        'convert parameters to a single 1D vector'
+        return np.hstack((np.asarray(rgb, dtype=float).flatten(), np.asarray(z, dtype=float).flatten(), np.array(v0, dtype=float), np.array(gamma, dtype=float)))
+
+    @staticmethod
+    def _vec2param(vec):
+        'convert 1D vector back to parameters'
+        return vec[0:9].reshape((3,3)), vec[9:12].reshape((1,3)), vec[12:15].tolist(), vec[15:18].tolist()
+
+    def _evaluate(self, vec):
+        'find residuals and their Jacobian for parameters in 1D vector vec'
+        if self._vec is not None and np.array_equal(vec, self._vec):
+            return
+        rgb, z, v0, gamma = self._vec2param(vec)
+
+        # activations; solve xyz = p @ rgb + z for p, without inverting rgb
+        p = np.linalg.solve(rgb.T, (self.xyz - z).T).T
+        rgbinv = np.linalg.solve(rgb, np.eye(3))
+
+        # predicted activations, and their derivatives with respect to v0 and gamma,
+        # for each channel; see _lummodel()
+        param = np.column_stack((np.zeros(3), np.ones(3), v0, gamma))
+        phat, dphat = _lummodel(param, np.ascontiguousarray(self.v.T))
+        self._r = (p - phat.T).ravel()
+
+        # Jacobian, with one row for each measurement and channel; from
+        # p = (xyz - z) @ inv(rgb), dp[i,k]/drgb[a,b] = -p[i,a] * inv(rgb)[b,k],
+        # and dp[i,k]/dz[b] = -inv(rgb)[b,k]
+        m = p.shape[0]
+        J = np.zeros((m, 3, 18))
+        J[:,:,0:9] = -np.einsum('ia,bk->ikab', p, rgbinv).reshape((m, 3, 9))
+        J[:,:,9:12] = -rgbinv.T
+        ch = np.arange(3)
+        J[:,ch,12+ch] = -dphat[:,:,2].T
+        J[:,ch,15+ch] = -dphat[:,:,3].T
+        self._J = J.reshape((3*m, 18))
+        self._vec = vec.copy()
+
+    def residuals(self, vec):
+        'residuals of activations, for parameters in 1D vector vec'
+        self._evaluate(vec)
+        return self._r
+
+    def jacobian(self, vec):
+        'Jacobian of residuals with respect to parameters in 1D vector vec'
+        self._evaluate(vec)
+        return self._J
 
     def plot(self):
         # plot photphor activations and model fit
+        import matplotlib.pyplot as plt
         p = (self.xyz - self.z) @ np.linalg.inv(self.rgb) # find the activations; solve xyz = p @ rgb + z for p
         vv = np.linspace(0,1,100)
         for k in range(3):
@@ -170,17 +460,74 @@ class CharXYZ:
         plt.legend(['red','green','blue'], frameon=False)
         plt.show()
 
-    def v2xyz(self, v):
+    def rgbinv(self):
+        'inverse of the matrix of primaries self.rgb; found once for each set of primaries, and then reused'
+        rgb = np.asarray(self.rgb, dtype=float)
+        if self._rgbinv is None or not np.array_equal(rgb, self._rgbkey):
+            self._rgbinv = np.linalg.inv(rgb)
+            self._rgbkey = rgb.copy()
+        return self._rgbinv
+
+    # v2xyz() and xyz2v() accept arrays of any shape whose last dimension has the
+    # three channels, e.g., m x 3 lists of colors or H x W x 3 images. the result is
+    # written to out if it's given, or else to a new array of type dtype (by default,
+    # float32 for float32 inputs, and float64 otherwise). the values are converted
+    # in chunks of chunksize colors, using the data type of the result, so that the
+    # temporary arrays stay small.
+
+    def v2xyz(self, v, out=None, dtype=None, chunksize=65536):
         'convert post-processed values v_k to XYZ coordinates'
-        p = [self.h(v=v[:,k], k=k) for k in range(3)]
-        p = np.column_stack(p)
-        return p @ rgb + z
+        rgb = np.asarray(self.rgb)
+        z = np.asarray(self.z).reshape(3)
+
+        def convert(v, out):
+            self._h3(v, out=v)
+            np.matmul(v, rgb.astype(out.dtype), out=out)
+            out += z.astype(out.dtype)
 
-    def xyz2v(self, xyz):
+        return _convert(convert, v, out, dtype, chunksize)
+
+    def xyz2v(self, xyz, out=None, dtype=None, chunksize=65536):
         'convert XYZ coordinates to post-processed values v_k'
-        p = (xyz-z) @ np.linalg.inv(rgb)
-        v = [self.hinv(p[:,k], k=k) for k in range(3)]
-        return np.column_stack(v)
+        rgbinv = self.rgbinv()
+        z = np.asarray(self.z).reshape(3)
+
+        def convert(xyz, out):
+            xyz -= z.astype(out.dtype)
+            np.matmul(xyz, rgbinv.astype(out.dtype), out=out)
+            self._hinv3(out, out=out)
+
+        return _convert(convert, xyz, out, dtype, chunksize)
+
+    def correction(self, u_k):
+        'tonemapping function for gamma correction, applied to each of the three channels of u_k (shape n, or n x 3); see equation (24), and CharLum.correction()'
+        w = np.asarray(self.z).reshape(3) @ self.rgbinv()
+        u_k = np.asarray(u_k)
+        if u_k.ndim == 1:
+            u_k = u_k[:, None]
+        t_k = [srgb(self.hinv((1+w[k])*u_k[:, min(k, u_k.shape[1]-1)] - w[k], k=k, maxout=False), maxout=False) for k in range(3)]
+        return np.column_stack(t_k)
+
+    def _h3(self, v, maxout=True, out=None):
+        'activation function for all three channels, for an array of values whose last dimension has the channels'
+        v0 = np.asarray(self.v0, dtype=v.dtype)
+        gamma = np.asarray(self.gamma, dtype=v.dtype)
+        ub = 1 if maxout else np.inf
+        out = np.clip(v, v0, ub, out=out)
+        out -= v0
+        out /= 1 - v0
+        return np.power(out, gamma, out=out)
+
+    def _hinv3(self, p, maxout=True, out=None):
+        'inverse of activation function for all three channels, for an array of values whose last dimension has the channels'
+        v0 = np.asarray(self.v0, dtype=p.dtype)
+        gamma = np.asarray(self.gamma, dtype=p.dtype)
+        ub = 1 if maxout else np.inf
+        out = np.clip(p, 0, ub, out=out)
+        np.power(out, 1/gamma, out=out)
+        out *= 1 - v0
+        out += v0
+        return out
 
     def h(self, v, v0=None, gamma=None, k=None, maxout=True):
         'activation function with parameters v0 and gamma, for channel k (R=0, G=1, B=2); maxout determines whether maximum value is 1.0'
@@ -1,7 +1,12 @@
 import os
+import json
+import hashlib
 import numpy as np
-from scipy.interpolate import interpn
-import matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
+
+# scipy and renderlog are imported in the functions that use them, so that importing
+# this module is fast, e.g., in worker processes that only need srgb() and
+# TonemapCube.apply()
 
 # constants in the sRGB nonlinearity
 Phi = 12.92
@@ -10,17 +15,121 @@ A = 0.055
 X = 0.04045
 Y = 0.0031308
 
-def srgb(x, maxout=True):
-    'sRGB nonlinearity; maxout determines whether the maximum value is 1.0'
+# knot point coordinates of the HDRP tonemapping stage, estimated empirically
+Knots = (0, 1e-09, 1.657e-09, 0.002830, 0.007137, 0.01269, 0.02051, 0.03086, 0.04479, 0.06444, 0.08989, 0.1252, 0.1726, 0.2370, 0.3253, 0.4422, 0.6039, 0.8207, 1.104, 1.495, 2.032, 2.756, 3.738, 5.083, 6.864, 9.347, 12.62, 17.18, 23.24, 31.48, 42.75, 57.66)
+
+def srgb(x, maxout=True, quantized=False, out=None):
+    'sRGB nonlinearity; maxout determines whether the maximum value is 1.0; quantized determines whether x is on the 8-bit grid k/255, and is converted by table lookup; out is an optional array for the result, which may be x itself'
+    if quantized:
+        return _lookup(_srgb_table, x, out, None if maxout else srgb)
     ub = 1 if maxout else np.inf
-    x = np.array(x).clip(0, ub)
-    return np.where(x<X, x/Phi, np.power((x+A)/(1+A), Gamma))
+    x = np.asarray(x)
+    if out is None:
+        out = np.empty(x.shape, dtype=np.result_type(x, 0.0))
+    np.clip(x, 0, ub, out=out)
+    k = out < X
+    xlow = out[k]
+    out += A
+    out /= 1+A
+    np.power(out, Gamma, out=out)
+    out[k] = xlow / Phi
+    return out
 
-def srgbinv(y, maxout=True):
-    'inverse of sRGB nonlinearity; maxout determines whether maximum value is 1.0'
+def srgbinv(y, maxout=True, quantized=False, out=None):
+    'inverse of sRGB nonlinearity; maxout determines whether maximum value is 1.0; quantized determines whether y is on the 8-bit grid k/255, and is converted by table lookup; out is an optional array for the result, which may be y itself'
+    if quantized:
+        return _lookup(_srgbinv_table, y, out, None if maxout else srgbinv)
     ub = 1 if maxout else np.inf
-    y = np.array(y).clip(0, ub)
-    return np.where(y<Y, y*Phi, np.power(y, 1/Gamma)*(1+A)-A)
+    y = np.asarray(y)
+    if out is None:
+        out = np.empty(y.shape, dtype=np.result_type(y, 0.0))
+    np.clip(y, 0, ub, out=out)
+    k = out < Y
+    ylow = out[k]
+    np.power(out, 1/Gamma, out=out)
+    out *= 1+A
+    out -= A
+    out[k] = ylow * Phi
+    return out
+
+def _lookup(table, x, out=None, f=None):
+    'look up values x on the 8-bit grid k/255 in a 256-entry table; values above 1 are clipped to 1, unless f is given, in which case they are found from f(x, maxout=False)'
+    x = np.asarray(x)
+
+    # find values above 1 before the lookup, since out may be x itself
+    above = None
+    if f is not None:
+        j = x > 1
+        if j.any():
+            above = (j, f(x[j], maxout=False))
+
+    k = np.rint(np.multiply(x, 255)).astype(np.intp)
+    if out is None or out.dtype == table.dtype:
+        out = np.take(table, k, mode='clip', out=out)
+    else:
+        out[...] = np.take(table, k, mode='clip')
+    if above is not None:
+        out[above[0]] = above[1]
+    return out
+
+# tables of srgb() and srgbinv() on the 8-bit grid k/255, for quantized inputs such
+# as the post-processed values v_k that Unity reads back from 8-bit RGB textures
+_srgb_table = srgb(np.arange(256)/255)
+_srgbinv_table = srgbinv(np.arange(256)/255)
+
+def rendermodel(m, d=None, a=None, i_d=None, i_a=None, costheta=None, e=None, c=1.0, lambertian=True, out=None, dtype=None, chunksize=16384):
+    'rendering model; find unprocessed color coordinates u_k for material color m, and for Lambertian materials, lighting parameters d, a, i_d, i_a, costheta, exposure e, and scale constant c'
+
+    # Lambertian materials, see equation (2) in main text:
+    #     u_k = c * srgb(m) * ( i_d * srgb(d) * max(costheta, 0) / pi + i_a * a ) / 2**e
+    # unlit materials:
+    #     u_k = srgb(m)
+    # m, d, and a are n x 3 arrays, and i_d, i_a, costheta, and e are 1D or n x 1 arrays.
+    # the result is written to out if it's given, or else to a new array of type dtype
+    # (float64 by default). samples are processed in chunks, with small temporary arrays
+    # that are reused from one chunk to the next, so that we make few passes over memory.
+    m = np.asarray(m)
+    if out is None:
+        out = np.empty(m.shape, dtype=np.float64 if dtype is None else dtype)
+    if not lambertian:
+        return srgb(m, out=out)
+
+    i_d, i_a, costheta, e = [np.reshape(x, (-1,1)) for x in (i_d, i_a, costheta, e)]
+    light = np.empty((min(chunksize, m.shape[0]), 3), dtype=out.dtype)
+    ambient = np.empty_like(light)
+    w = np.empty((light.shape[0], 1), dtype=out.dtype)
+    for j1 in range(0, m.shape[0], chunksize):
+        j2 = min(j1 + chunksize, m.shape[0])
+        k = slice(j1, j2)
+        u, L, G, W = out[k], light[:j2-j1], ambient[:j2-j1], w[:j2-j1]
+
+        # directional light
+        srgb(d[k], out=L)
+        np.clip(costheta[k], 0, None, out=W)
+        W *= i_d[k]
+        W *= 1/np.pi
+        L *= W
+
+        # ambient light
+        np.multiply(a[k], i_a[k], out=G)
+        L += G
+
+        # material color, exposure, and scale constant
+        srgb(m[k], out=u)
+        u *= L
+        np.negative(e[k], out=W)
+        np.exp2(W, out=W)
+        W *= c
+        u *= W
+
+    return out
+
+def dsrgbinv(y, maxout=True):
+    'derivative of inverse of sRGB nonlinearity; maxout determines whether maximum value is 1.0'
+    ub = 1 if maxout else np.inf
+    y = np.array(y)
+    dy = np.where(y<Y, Phi, (1+A)/Gamma * np.power(y.clip(Y, None), 1/Gamma-1))
+    return np.where((y<0) | (y>ub), 0, dy)
 
 def cubetag(fname):
     'from filename of cube file, return a tag to use in filename of text data files'
@@ -29,15 +138,215 @@ def cubetag(fname):
     _, f = os.path.split(fname)
     return '_' + os.path.splitext(f)[0]
 
+def _readonly(a):
+    'return a read-only view of an array'
+    a = np.asarray(a).view()
+    a.flags.writeable = False
+    return a
+
+def _channels(cube):
+    'if a 4D cube processes the three color channels independently, return an n x 3 array of its channel outputs; otherwise return None'
+    t_knot = np.column_stack((cube[:,0,0,0], cube[0,:,0,1], cube[0,0,:,2]))
+    if (cube[...,0] == t_knot[:,0].reshape((-1,1,1))).all() \
+            and (cube[...,1] == t_knot[:,1].reshape((1,-1,1))).all() \
+            and (cube[...,2] == t_knot[:,2].reshape((1,1,-1))).all():
+        return t_knot
+    return None
+
+def _expandchannels(t_knot):
+    'from an n x 3 array of channel outputs, create a 4D cube that processes the three color channels independently'
+    n = t_knot.shape[0]
+    cubeR = np.tile(t_knot[:,0].reshape((-1,1,1,1)),(1,n,n,1))
+    cubeG = np.tile(t_knot[:,1].reshape((1,-1,1,1)),(n,1,n,1))
+    cubeB = np.tile(t_knot[:,2].reshape((1,1,-1,1)),(n,n,1,1))
+    return np.concatenate((cubeR, cubeG, cubeB), axis=3)
+
+def _applychannels(locator, t_knot, u_k):
+    'interpolate each color channel of u_k separately, in an n x 3 array of channel outputs t_knot at the knot points of locator'
+    t_k = np.empty(u_k.shape)
+    for k in range(3):
+        t_k[:,k] = locator.interp(u_k[:,k], t_knot[:,k])
+    return t_k
+
+def _trilinear(locator, cube, u_k, cubenum=0):
+    'trilinear interpolation of m x 3 values u_k in a 4D cube, or in cubes cubenum (an integer or m-vector) of a stack of 4D cubes, using a knot interval locator'
+    n = locator.u_knot.size
+    i, wi = locator.bracket(u_k[:,0])
+    j, wj = locator.bracket(u_k[:,1])
+    k, wk = locator.bracket(u_k[:,2])
+
+    # add weighted values at the eight corners of the cell containing u_k
+    flat = cube.reshape((-1,3))
+    base = ((cubenum*n + i)*n + j)*n + k
+    t_k = np.zeros(u_k.shape)
+    for c in range(8):
+        di, dj, dk = (c >> 2) & 1, (c >> 1) & 1, c & 1
+        w = (wi if di else 1-wi) * (wj if dj else 1-wj) * (wk if dk else 1-wk)
+        t_k += w.reshape((-1,1)) * flat[base + (di*n + dj)*n + dk]
+    return t_k
+
+def _readcube(filename):
+    'read a cube file, and return its 4D array of RGB values'
+    with open(filename, 'r') as f:
+        cubetext = f.read()
+
+    # the header has keyword lines (TITLE, LUT_3D_SIZE, DOMAIN_MIN, DOMAIN_MAX),
+    # and possibly comments and blank lines; the RGB values follow, and are parsed
+    # in one call, instead of one line at a time
+    lines = cubetext.split('\n')
+    n = None
+    for h, line in enumerate(lines):
+        words = line.split()
+        if not words or words[0].startswith('#'):
+            continue
+        if not words[0][0].isalpha():
+            break
+        if words[0] == 'LUT_3D_SIZE':
+            n = int(words[1])
+    else:
+        h = len(lines)
+    mat = np.array(' '.join(lines[h:]).split(), dtype=float)
+    if mat.size % 3:
+        raise Exception('number of values is not a multiple of 3')
+    mat = mat.reshape((-1,3))
+
+    m = mat.shape[0]
+    if n is None:
+        n = round(m ** (1/3))
+    if n**3 != m:
+        raise Exception('number of rows is not a perfect cube, or does not match LUT_3D_SIZE')
+
+    return mat.reshape((n,n,n,3), order='F')
+
+def _writecube(filename, cube):
+    'write a 4D array of RGB values to a cube file'
+    n = cube.shape[0]
+    mat = cube.reshape((n**3,3), order='F')
+
+    # format all rows in one call; the output is the same as np.savetxt(f, mat, fmt='%.6f')
+    with open(filename, 'w') as f:
+        f.write(f'TITLE "{filename}"\n')
+        f.write(f'LUT_3D_SIZE {n}\n')
+        f.write('DOMAIN_MIN 0.0 0.0 0.0\n')
+        f.write('DOMAIN_MAX 1.0 1.0 1.0\n')
+        f.write(('%.6f %.6f %.6f\n' * mat.shape[0]) % tuple(mat.ravel().tolist()))
+
+# class for finding the knot intervals that contain a set of values. the knot points
+# are roughly evenly spaced in log(u) above the third one, so we divide log(u) into
+# uniform buckets, each narrower than half the smallest gap between knot points, and
+# precompute the knot interval at the start of each bucket. a value then needs one
+# table lookup and at most one comparison, instead of a binary search.
+class KnotLocator:
+
+    def __init__(self, u_knot, lo=2, maxbins=65536):
+
+        # knot point coordinates; values are clipped to [ u_knot[lo], u_knot[-1] ]
+        self.u_knot = np.array(u_knot, dtype=float)
+        self.lo = lo
+        n = self.u_knot.size
+
+        # table of knot intervals for buckets in log(u); if the knot points are not
+        # positive and strictly increasing from u_knot[lo], or would need more than
+        # maxbins buckets, then self.table is None and we use a binary search instead
+        self.table = None
+        u = self.u_knot[lo:]
+        if u[0] > 0 and (np.diff(u) > 0).all():
+            logu = np.log(u)
+            span = logu[-1] - logu[0]
+            nbin = int(np.ceil(2 * span / np.diff(logu).min()))
+            if nbin <= maxbins:
+                self.offset = logu[0]
+                self.scale = nbin / span
+                # shrink the bucket starts slightly, so that rounding error in log()
+                # can't put a value in a bucket that starts above it
+                start = np.exp(self.offset + np.arange(nbin) / self.scale) * (1 - 1e-9)
+                self.table = (np.searchsorted(self.u_knot, start, side='right') - 1).clip(lo, n-2)
+
+    def locate(self, x):
+        'index i of the knot interval from u_knot[i] to u_knot[i+1] that contains each value in x; x must be clipped to [ u_knot[lo], u_knot[-1] ]'
+        n = self.u_knot.size
+        if self.table is None:
+            return (np.searchsorted(self.u_knot, x, side='right') - 1).clip(self.lo, n-2)
+        b = np.log(x)
+        b -= self.offset
+        b *= self.scale
+        b = b.astype(np.intp)
+        b.clip(0, self.table.size-1, out=b)
+        i = self.table[b]
+        i += x >= self.u_knot[i+1]
+        i.clip(max=n-2, out=i)
+        return i
+
+    def bracket(self, x):
+        'for values x, clipped to [ u_knot[lo], u_knot[-1] ], find index i of the knot interval containing x, and weight w of knot i+1'
+        x = np.clip(x, self.u_knot[self.lo], self.u_knot[-1])
+        i = self.locate(x)
+        h = self.u_knot[i+1] - self.u_knot[i]
+        w = np.divide(x - self.u_knot[i], h, out=np.zeros(x.shape), where=h>0)
+        return i, w
+
+    def interp(self, x, t_knot):
+        'linear interpolation of 1D values x, clipped to [ u_knot[lo], u_knot[-1] ], in outputs t_knot at knot points'
+        # on each knot interval, the interpolated value is an affine function of x
+        h = np.diff(self.u_knot)
+        slope = np.divide(np.diff(t_knot), h, out=np.zeros(h.shape), where=h>0)
+        intercept = t_knot[:-1] - slope * self.u_knot[:-1]
+        x = np.clip(x, self.u_knot[self.lo], self.u_knot[-1])
+        i = self.locate(x)
+        t = slope[i]
+        t *= x
+        t += intercept[i]
+        return t
+
+# base class for tonemapping models, with the knot point coordinates and a locator
+# for them. u_knot is a property, so that we can discard the locator (and anything
+# else that depends on the knot points; see _knotschanged()) when it changes, and it
+# is stored as a read-only copy of the array it is set to, so it can only be changed
+# by assigning a new array, e.g., instead of
+#     t.u_knot[i1:i2+1] = x
+# use
+#     u_knot = t.u_knot.copy()
+#     u_knot[i1:i2+1] = x
+#     t.u_knot = u_knot
+class _KnotPoints:
+
+    @property
+    def u_knot(self):
+        'knot point coordinates'
+        return self._u_knot
+
+    @u_knot.setter
+    def u_knot(self, u_knot):
+        self._u_knot = _readonly(np.array(u_knot, dtype=float))
+        self._locator = None
+        self._knotschanged()
+
+    def _knotschanged(self):
+        'discard anything else that depends on the knot points; called when they are assigned a new value'
+        pass
+
+    def locator(self):
+        'return knot interval locator for the current knot points; created on first use, and then reused'
+        if self._locator is None:
+            self._locator = KnotLocator(self.u_knot)
+        return self._locator
+
 # class for tonemapping model
-class TonemapCube:
+class TonemapCube(_KnotPoints):
     
     def __init__(self, filename=''):
-        
+
+        # interpolator for the current knot points, cube, and interpolation method,
+        # and locator for the current knot points; created on first use, and discarded
+        # when any of these is assigned a new value
+        self._interp = None
+        self._locator = None
+
         # knot point coordinates, estimated empirically
-        self.u_knot = np.array([0, 1e-09, 1.657e-09, 0.002830, 0.007137, 0.01269, 0.02051, 0.03086, 0.04479, 0.06444, 0.08989, 0.1252, 0.1726, 0.2370, 0.3253, 0.4422, 0.6039, 0.8207, 1.104, 1.495, 2.032, 2.756, 3.738, 5.083, 6.864, 9.347, 12.62, 17.18, 23.24, 31.48, 42.75, 57.66])
+        self.u_knot = Knots
 
         # 4D array of RGB values; outputs of tonemapping at knot points
+        # (setting the cube also sets self.t_knot; see below)
         self.cube = None
         
         # interpolation method
@@ -47,7 +356,52 @@ class TonemapCube:
         self.filename = filename
         if self.filename:
             self.load(filename)
-    
+
+    # u_knot, cube, and method are properties, so that we can discard the interpolator
+    # when they change. like u_knot (see _KnotPoints), cube is stored as a read-only
+    # copy of the array it is set to.
+
+    def _knotschanged(self):
+        'discard the interpolator; called when the knot points are assigned a new value'
+        self._interp = None
+
+    @property
+    def cube(self):
+        '4D array of RGB values; outputs of tonemapping at knot points'
+        return self._cube
+
+    @cube.setter
+    def cube(self, cube):
+        # if the cube processes the color channels independently, keep an n x 3 array
+        # of the channel outputs at the knot points in self.t_knot, so that apply() can
+        # use three 1D lookups instead of 3D interpolation; otherwise self.t_knot is None
+        self._cube = None if cube is None else _readonly(np.array(cube, dtype=float))
+        t_knot = None if cube is None else _channels(self._cube)
+        self._t_knot = None if t_knot is None else _readonly(t_knot)
+        self._interp = None
+
+    @property
+    def t_knot(self):
+        'n x 3 array of channel outputs at knot points, if the cube processes the color channels independently; otherwise None'
+        return self._t_knot
+
+    @property
+    def method(self):
+        'interpolation method; see scipy.interpolate.RegularGridInterpolator'
+        return self._method
+
+    @method.setter
+    def method(self, method):
+        self._method = method
+        self._interp = None
+
+    def interpolator(self):
+        'return interpolator for the current knot points, cube, and interpolation method; created on first use, and then reused'
+        if self._interp is None:
+            from scipy.interpolate import RegularGridInterpolator
+            self._interp = RegularGridInterpolator(3*(self.u_knot,), self.cube, method=self.method)
+        return self._interp
+
     def setchannels(self, t_knot):
         'from n x 1 or n x 3 array, create a 4D array for tonemapping that assumes independent channels'
 
@@ -59,62 +413,1165 @@ class TonemapCube:
         n = t_knot.shape[0]
         if n != self.u_knot.size:
             raise Exception('array size does not match number of knot points')
-        cubeR = np.tile(t_knot[:,0].reshape((-1,1,1,1)),(1,n,n,1))
-        cubeG = np.tile(t_knot[:,1].reshape((1,-1,1,1)),(n,1,n,1))
-        cubeB = np.tile(t_knot[:,2].reshape((1,1,-1,1)),(n,n,1,1))
-        self.cube = np.concatenate((cubeR, cubeG, cubeB), axis=3)
+        self._cube = _readonly(_expandchannels(t_knot))
+        self._t_knot = _readonly(np.array(t_knot, dtype=float))
+        self._interp = None
 
     def apply(self, u_k):
         'apply tonemapping model to unprocessed values u_k; look up tonemapped values in cube, interpolating if necessary'
         if u_k.shape[1] != 3:
             raise Exception('u_k must be an m x 3 array')
+        if self.t_knot is not None and self.method == 'linear':
+            # independent channels; interpolate each channel separately
+            return _applychannels(self.locator(), self.t_knot, u_k)
+        if self.method == 'linear':
+            return _trilinear(self.locator(), self.cube, u_k)
         u_k = u_k.clip(self.u_knot[2], self.u_knot[-1])
-        t_k = interpn(3*(self.u_knot,), self.cube, u_k, method=self.method)
+        t_k = self.interpolator()(u_k)
         return t_k
+
+    def applyframe(self, frame, postprocess=True, out=None, tilesize=65536, workers=None):
+        'apply tonemapping model to an H x W x 3 frame, or an N x H x W x 3 sequence of frames; see tonemapframe()'
+        return tonemapframe(self, frame, postprocess=postprocess, out=out, tilesize=tilesize, workers=workers)
+
+    def operator(self, u_k):
+        'return sparse m x n**3 matrix W of linear interpolation weights for unprocessed values u_k, so that apply(u_k) is W @ cube.reshape((n**3, 3))'
+        from scipy import sparse
+        if u_k.shape[1] != 3:
+            raise Exception('u_k must be an m x 3 array')
+        if self.method != 'linear':
+            raise Exception('interpolation operator requires linear interpolation')
+
+        # find knot intervals and weights along each axis
+        n = self.u_knot.size
+        m = u_k.shape[0]
+        locator = self.locator()
+        i, wi = locator.bracket(u_k[:,0])
+        j, wj = locator.bracket(u_k[:,1])
+        k, wk = locator.bracket(u_k[:,2])
+
+        # each row has weights for the eight corners of the cell containing u_k
+        col = np.empty((m, 8), dtype=np.intp)
+        val = np.empty((m, 8))
+        for c in range(8):
+            di, dj, dk = (c >> 2) & 1, (c >> 1) & 1, c & 1
+            col[:,c] = ((i+di)*n + (j+dj))*n + (k+dk)
+            val[:,c] = (wi if di else 1-wi) * (wj if dj else 1-wj) * (wk if dk else 1-wk)
+        row = np.arange(0, 8*m+1, 8)
+        return sparse.csr_matrix((val.ravel(), col.ravel(), row), shape=(m, n**3))
         
     def load(self, filename=''):
         'load cube file'
         if filename:
             self.filename = filename
         
-        with open(self.filename, 'r') as f:
-            cubetext = f.read()
-        
-        mat = []
-        for line in cubetext.split('\n'):
-            rgb = np.fromstring(line, sep=' ')
-            if rgb.size == 3:
-                mat.append(rgb)
-        mat = np.array(mat)
-        
-        n = mat.shape[0] ** (1/3)
-        if abs(n-round(n)) > 1e-6:
-            raise Exception('number of rows is not a perfect cube')
-        n = round(n)
+        cube = _readcube(self.filename)
+        n = cube.shape[0]
         if n != self.u_knot.size:
             raise Exception('cube size does not match number of knot points')
 
-        self.cube = mat.reshape((n,n,n,3), order='F')
+        self.cube = cube
 
     def save(self, filename=''):
         'save cube file'
         if filename:
             self.filename = filename
 
-        n = self.cube.shape[0]
-        mat = self.cube.reshape((n**3,3), order='F')
-
-        f = open(self.filename, 'w')
-        f.write(f'TITLE "{self.filename}"\n')
-        f.write(f'LUT_3D_SIZE {n}\n')
-        f.write('DOMAIN_MIN 0.0 0.0 0.0\n')
-        f.write('DOMAIN_MAX 1.0 1.0 1.0\n')
-        np.savetxt(f, mat, fmt='%.6f')
-        f.close()
+        _writecube(self.filename, self.cube)
 
     def __repr__(self):
         'string representation of object'
         s = 'u_knot = ' + str(self.u_knot) + '\n'
         s += 'cube.shape = ' + str(self.cube.shape) + '\n'
+        s += 'separable = ' + str(self.t_knot is not None) + '\n'
+        s += 'filename = "' + self.filename + '"\n'
+        return s
+
+# class for tonemapping model with independent color channels; stores only the
+# n x 3 array of channel outputs at the knot points, and expands it to a 4D cube
+# only when it is needed, e.g., when saving a cube file
+class SeparableTonemap(_KnotPoints):
+
+    def __init__(self, filename=''):
+
+        # locator for the current knot points; created on first use, and discarded
+        # when the knot points are assigned a new value
+        self._locator = None
+
+        # knot point coordinates, estimated empirically
+        self.u_knot = Knots
+
+        # n x 3 array of RGB values; outputs of tonemapping at knot points
+        self.t_knot = None
+
+        # interpolation method; only linear interpolation is supported
+        self.method = 'linear'
+
+        # filename of cube file
+        self.filename = filename
+        if self.filename:
+            self.load(filename)
+
+    @property
+    def cube(self):
+        '4D array of RGB values; outputs of tonemapping at knot points'
+        return _expandchannels(self.t_knot)
+
+    def setchannels(self, t_knot):
+        'from n x 1 or n x 3 array, set the outputs of tonemapping at knot points for each channel'
+
+        # from 1D or n x 1 array, make a n x 3 array
+        if t_knot.ndim==1 or t_knot.shape[1] == 1:
+            t_knot = np.column_stack((t_knot, t_knot, t_knot))
+
+        n = t_knot.shape[0]
+        if n != self.u_knot.size:
+            raise Exception('array size does not match number of knot points')
+        self.t_knot = t_knot.astype(float)
+
+    def apply(self, u_k):
+        'apply tonemapping model to unprocessed values u_k; look up tonemapped values for each channel, interpolating if necessary'
+        if u_k.shape[1] != 3:
+            raise Exception('u_k must be an m x 3 array')
+        return _applychannels(self.locator(), self.t_knot, u_k)
+
+    def applyframe(self, frame, postprocess=True, out=None, tilesize=65536, workers=None):
+        'apply tonemapping model to an H x W x 3 frame, or an N x H x W x 3 sequence of frames; see tonemapframe()'
+        return tonemapframe(self, frame, postprocess=postprocess, out=out, tilesize=tilesize, workers=workers)
+
+    def operator(self, u_k):
+        'return sparse 3m x 3n matrix W of linear interpolation weights for unprocessed values u_k, so that apply(u_k).T.flatten() is W @ t_knot.T.flatten()'
+        from scipy import sparse
+        if u_k.shape[1] != 3:
+            raise Exception('u_k must be an m x 3 array')
+
+        # the matrix is block diagonal, with one m x n block for each channel;
+        # each row has weights for the two knot points on either side of u_k
+        n = self.u_knot.size
+        m = u_k.shape[0]
+        i, w = self.locator().bracket(u_k.T)
+        i += n * np.arange(3).reshape((3,1))
+        col = np.stack((i, i+1), axis=-1)
+        val = np.stack((1-w, w), axis=-1)
+        row = np.arange(0, 6*m+1, 2)
+        return sparse.csr_matrix((val.ravel(), col.ravel(), row), shape=(3*m, 3*n))
+
+    def fit(self, u, t, free=None, monotone=False, bounds=None):
+        'set outputs at knot points so that the tonemap approximates target values t at unprocessed values u, by linear least squares'
+
+        # u is a 1D or m x 3 array of unprocessed values, and t is a 1D or m x 3
+        # array of target tonemapped values, e.g., a target function evaluated at u.
+        # the tonemap is linear in the outputs at the knot points, so the best fit
+        # is a linear least-squares problem, which we solve directly for each channel.
+        #
+        # free is an index into the knot points (e.g., a slice) that selects the
+        # outputs to fit; the other outputs keep their current values in self.t_knot.
+        # if free is None, then all outputs are fitted.
+        #
+        # bounds is an optional (lower, upper) pair of limits on the fitted outputs.
+        # if monotone is True, then the fitted outputs are constrained to increase
+        # from one knot point to the next, starting from the output at the knot
+        # point before the first free one; free must then select a contiguous range
+        # of knot points, and the upper limit in bounds is applied by clipping.
+
+        # from 1D arrays, make m x 3 arrays
+        u = np.asarray(u, dtype=float)
+        t = np.asarray(t, dtype=float)
+        if u.ndim == 1:
+            u = np.column_stack((u, u, u))
+        if t.ndim == 1:
+            t = np.column_stack((t, t, t))
+        if u.shape != t.shape or u.shape[1] != 3:
+            raise Exception('u and t must be matching 1D or m x 3 arrays')
+
+        # choose the outputs to fit
+        n = self.u_knot.size
+        if self.t_knot is None:
+            if free is not None:
+                raise Exception('outputs at knot points must be set before fitting a subset of them')
+            self.t_knot = np.zeros((n, 3))
+        isfree = np.zeros(n, dtype=bool)
+        isfree[slice(None) if free is None else free] = True
+        ifree = isfree.nonzero()[0]
+        if monotone and (ifree.size == 0 or np.any(np.diff(ifree) != 1)):
+            raise Exception('monotonic fit requires a contiguous range of free knot points')
+        lb, ub = (-np.inf, np.inf) if bounds is None else bounds
+
+        # interpolation weights; the operator has one m x n block for each channel
+        m = u.shape[0]
+        W = self.operator(u)
+        t_knot = self.t_knot.copy()
+        for k in range(3):
+            Wk = W[k*m:(k+1)*m, k*n:(k+1)*n]
+            A = Wk[:, isfree].toarray()
+            b = t[:,k] - Wk[:, ~isfree] @ t_knot[~isfree, k]
+            x0 = t_knot[isfree, k]
+            if monotone:
+                # fit the first free output and the increments after it, which
+                # are non-negative; the outputs are cumulative sums
+                A = np.cumsum(A[:, ::-1], axis=1)[:, ::-1]
+                x0 = np.concatenate((x0[:1], np.diff(x0).clip(min=0)))
+                t0 = t_knot[ifree[0]-1, k] if ifree[0] > 0 else -np.inf
+                xlb = np.zeros(ifree.size)
+                xub = np.full(ifree.size, np.inf)
+                xlb[0] = max(lb, t0)
+                xub[0] = ub
+            else:
+                xlb = np.full(ifree.size, lb)
+                xub = np.full(ifree.size, ub)
+            # solve for the change from the current outputs, so that outputs
+            # that the data do not determine (e.g., at knot points between two
+            # samples) keep their current values
+            bounded = np.isfinite(xlb).any() or np.isfinite(xub).any()
+            if bounded:
+                x0 = x0.clip(xlb, xub)
+            b = b - A @ x0
+            if bounded:
+                from scipy.optimize import lsq_linear
+                dx = lsq_linear(A, b, bounds=(xlb-x0, xub-x0)).x
+            else:
+                dx = np.linalg.lstsq(A, b, rcond=None)[0]
+            x = x0 + dx
+            t_knot[isfree, k] = np.cumsum(x).clip(max=ub) if monotone else x
+        self.t_knot = t_knot
+        return t_knot
+
+    def load(self, filename=''):
+        'load cube file; the cube must process the three color channels independently'
+        if filename:
+            self.filename = filename
+
+        cube = _readcube(self.filename)
+        n = cube.shape[0]
+        if n != self.u_knot.size:
+            raise Exception('cube size does not match number of knot points')
+
+        t_knot = _channels(cube)
+        if t_knot is None:
+            raise Exception('cube does not process the color channels independently')
+        self.t_knot = t_knot
+
+    def save(self, filename=''):
+        'save cube file'
+        if filename:
+            self.filename = filename
+
+        _writecube(self.filename, self.cube)
+
+    def __repr__(self):
+        'string representation of object'
+        s = 'u_knot = ' + str(self.u_knot) + '\n'
+        s += 't_knot.shape = ' + str(self.t_knot.shape) + '\n'
         s += 'filename = "' + self.filename + '"\n'
         return s
+
+def tonemapframe(tonemap, frame, postprocess=True, out=None, tilesize=65536, workers=None):
+    'apply a tonemapping object (e.g., TonemapCube or SeparableTonemap) to an H x W x 3 frame of unprocessed values, or an N x H x W x 3 sequence of frames, and if postprocess is True, apply the inverse sRGB nonlinearity to get post-processed values'
+
+    # this is an offline preview of what the HDRP tonemapping and post-processing
+    # stages show for a rendered frame. the pixels are processed in tiles of tilesize
+    # pixels, which are spread over a pool of workers threads (by default, one per
+    # CPU). numpy releases the GIL in most of the array operations in apply() and
+    # srgbinv(), so the threads run in parallel, and since each thread only makes
+    # temporary arrays the size of one tile, peak memory is about workers * tilesize
+    # pixels, plus the frame and the result, regardless of the resolution. the result
+    # is written to out if it's given, or else to a new array of the same type as the
+    # frame (or float32, for integer frames).
+    frame = np.asarray(frame)
+    if frame.ndim < 3 or frame.shape[-1] != 3:
+        raise Exception('frame must be an H x W x 3 or N x H x W x 3 array')
+    if out is None:
+        out = np.empty(frame.shape, dtype=np.result_type(frame.dtype, np.float32))
+    if out.shape != frame.shape or not out.flags.c_contiguous:
+        raise Exception('out must be a contiguous array the same shape as frame')
+    pixels = frame.reshape((-1,3))
+    result = out.reshape((-1,3))
+    m = pixels.shape[0]
+
+    # create the interpolator and locator before the threads start, so that they
+    # share one copy instead of each making their own
+    tonemap.apply(pixels[:1])
+
+    def work(a):
+        t_k = tonemap.apply(pixels[a:a+tilesize])
+        if postprocess:
+            srgbinv(t_k, out=t_k)
+        result[a:a+tilesize] = t_k
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for _ in pool.map(work, range(0, m, tilesize)):
+            pass
+    return out
+
+# class for a stack of K tonemapping models that share the same knot points, e.g.,
+# the cube files used in one set of render_random runs. the cubes are stored in a
+# single K x n x n x n x 3 array, and each sample is tonemapped with its own cube in
+# one pass, so there is no loop over cubes, and no masking of samples by cube.
+class TonemapStack(_KnotPoints):
+
+    def __init__(self, filelist=()):
+
+        # locator for the current knot points; created on first use, and discarded
+        # when the knot points are assigned a new value
+        self._locator = None
+
+        # knot point coordinates, estimated empirically; shared by all cubes
+        self.u_knot = Knots
+
+        # K x n x n x n x 3 array of RGB values; outputs of tonemapping at knot points
+        # for each cube (setting the cubes also sets self.t_knot; see below)
+        self.cubes = None
+
+        # interpolation method; only linear interpolation is supported
+        self.method = 'linear'
+
+        # filenames of cube files
+        self.filelist = list(filelist)
+        if self.filelist:
+            self.load()
+
+    # cubes is a property, and is stored as a read-only copy, like u_knot (see
+    # _KnotPoints); t_knot is read-only, and is set only by the cubes setter and
+    # setchannels(), so that it always matches the cubes
+
+    @property
+    def cubes(self):
+        'K x n x n x n x 3 array of RGB values; outputs of tonemapping at knot points for each cube'
+        return self._cubes
+
+    @cubes.setter
+    def cubes(self, cubes):
+        # if every cube processes the color channels independently, keep a K x n x 3
+        # array of the channel outputs at the knot points in self.t_knot, so that
+        # apply() can use 1D lookups instead of 3D interpolation; otherwise
+        # self.t_knot is None
+        self._cubes = None if cubes is None else _readonly(np.array(cubes, dtype=float))
+        self._t_knot = None
+        if cubes is not None:
+            t_knot = [_channels(c) for c in self._cubes]
+            if all(t is not None for t in t_knot):
+                self._t_knot = _readonly(np.stack(t_knot))
+
+    @property
+    def t_knot(self):
+        'K x n x 3 array of channel outputs at knot points, if every cube processes the color channels independently; otherwise None'
+        return self._t_knot
+
+    @classmethod
+    def fromtonemaps(cls, tonemap):
+        'create a stack from a list of tonemapping objects (e.g., TonemapCube or SeparableTonemap) with the same knot points'
+        stack = cls()
+        stack.u_knot = tonemap[0].u_knot
+        if any(not np.array_equal(t.u_knot, stack.u_knot) for t in tonemap):
+            raise Exception('tonemaps in a stack must have the same knot points')
+        stack.cubes = np.stack([t.cube for t in tonemap])
+        stack.filelist = [t.filename for t in tonemap]
+        return stack
+
+    def setchannels(self, t_knot):
+        'from K x n x 3 array, create a stack of 4D arrays for tonemapping that assume independent channels'
+        if t_knot.ndim != 3 or t_knot.shape[1:] != (self.u_knot.size, 3):
+            raise Exception('array must be K x n x 3, where n is the number of knot points')
+        self._cubes = _readonly(np.stack([_expandchannels(t) for t in t_knot]))
+        self._t_knot = _readonly(np.array(t_knot, dtype=float))
+
+    def apply(self, u_k, cubenum):
+        'apply tonemapping model to unprocessed values u_k, using cube cubenum[i] for sample i; look up tonemapped values in cubes, interpolating if necessary'
+        if u_k.shape[1] != 3:
+            raise Exception('u_k must be an m x 3 array')
+        cubenum = np.asarray(cubenum, dtype=np.intp).reshape((-1,1))
+        if cubenum.shape[0] != u_k.shape[0]:
+            raise Exception('cubenum must have one entry for each row of u_k')
+        if self.t_knot is None:
+            return _trilinear(self.locator(), self.cubes, u_k, cubenum.ravel())
+
+        # independent channels; on each knot interval, the tonemapped value is an
+        # affine function of u_k, with a slope and intercept for each cube and channel
+        n = self.u_knot.size
+        h = np.diff(self.u_knot).reshape((1,-1,1))
+        slope = np.divide(np.diff(self.t_knot, axis=1), h, out=np.zeros((len(self), n-1, 3)), where=h>0)
+        intercept = self.t_knot[:,:-1,:] - slope * self.u_knot[:-1].reshape((1,-1,1))
+
+        # index of the slope and intercept for each sample and channel
+        locator = self.locator()
+        x = np.clip(u_k, self.u_knot[locator.lo], self.u_knot[-1])
+        idx = locator.locate(x)
+        idx += cubenum * (n-1)
+        idx *= 3
+        idx += np.arange(3)
+        t_k = slope.take(idx)
+        t_k *= x
+        t_k += intercept.take(idx)
+        return t_k
+
+    def load(self, filelist=None):
+        'load cube files'
+        if filelist is not None:
+            self.filelist = list(filelist)
+
+        cubes = np.stack([_readcube(f) for f in self.filelist])
+        n = cubes.shape[1]
+        if n != self.u_knot.size:
+            raise Exception('cube size does not match number of knot points')
+
+        self.cubes = cubes
+
+    def save(self, filelist=None):
+        'save cube files'
+        if filelist is not None:
+            self.filelist = list(filelist)
+        if len(self.filelist) != len(self):
+            raise Exception('number of filenames does not match number of cubes')
+
+        for f, cube in zip(self.filelist, self.cubes):
+            _writecube(f, cube)
+
+    def __len__(self):
+        'number of cubes'
+        return 0 if self.cubes is None else self.cubes.shape[0]
+
+    def __repr__(self):
+        'string representation of object'
+        s = 'u_knot = ' + str(self.u_knot) + '\n'
+        s += 'cubes.shape = ' + str(None if self.cubes is None else self.cubes.shape) + '\n'
+        s += 'separable = ' + str(self.t_knot is not None) + '\n'
+        s += 'filelist = ' + str(self.filelist) + '\n'
+        return s
+
+# cube libraries are single binary files that hold many named cubes, each with its
+# knot points and a dict of metadata (e.g., the function it implements). the file
+# starts with the 8-byte tag _libtag and an 8-byte little-endian length, followed by
+# a JSON header that describes the cubes, padded to a multiple of 64 bytes. after
+# the header are two arrays of little-endian doubles: a K1 x n x 3 array of channel
+# outputs for cubes that process the color channels independently, and a
+# K2 x n x n x n x 3 array for the other cubes. the arrays are memory-mapped, so
+# opening a cube reads only that cube from the file, with no parsing. the methods of
+# CubeLibrary return copies of the cubes, never views of the memory maps, so that
+# save() can release the maps before it replaces the file (on Windows, a file can't
+# be replaced while it's mapped). other CubeLibrary objects that have the same file
+# open keep the version they loaded until they call load() again.
+_libtag = b'HDRPCUBE'
+
+def _writelibrary(filename, n, entries, channels, cubes):
+    'write a cube library file, from a list of cube descriptions, and arrays of channel outputs and cubes'
+    header = {'n': n, 'cubes': entries, 'channels': list(channels.shape), 'full': list(cubes.shape)}
+    text = json.dumps(header).encode('utf-8')
+    start = -(-(16 + len(text)) // 64) * 64
+    text += b' ' * (start - 16 - len(text))
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wb') as f:
+        f.write(_libtag)
+        f.write(len(text).to_bytes(8, 'little'))
+        f.write(text)
+        f.write(np.ascontiguousarray(channels, dtype='<f8').tobytes())
+        f.write(np.ascontiguousarray(cubes, dtype='<f8').tobytes())
+    os.replace(tmpname, filename)
+
+# class for a library of named cubes, stored in a cube library file
+class CubeLibrary:
+
+    def __init__(self, filename=''):
+
+        # number of knot points in each cube
+        self.n = len(Knots)
+
+        # descriptions of cubes, by name; each is a dict with the cube's knot points
+        # ('u_knot'), metadata ('meta'), and where its values are stored ('kind' is
+        # 'channels' or 'full', and 'index' is its position in that array)
+        self._entries = {}
+
+        # arrays of channel outputs and cubes; memory-mapped from the file, or, for
+        # cubes that have been added since the file was loaded, lists of arrays
+        self._channels = np.zeros((0, self.n, 3))
+        self._cubes = np.zeros((0, self.n, self.n, self.n, 3))
+        self._added = {}
+
+        # filename of library file
+        self.filename = filename
+        if self.filename:
+            self.load(filename)
+
+    @classmethod
+    def open(cls, filename):
+        'open library file if it exists, or else create an empty library that will be saved to it'
+        if os.path.exists(filename):
+            return cls(filename)
+        lib = cls()
+        lib.filename = filename
+        return lib
+
+    def load(self, filename=''):
+        'open library file, and memory-map its arrays'
+        if filename:
+            self.filename = filename
+
+        with open(self.filename, 'rb') as f:
+            if f.read(8) != _libtag:
+                raise Exception('file is not a cube library')
+            size = int.from_bytes(f.read(8), 'little')
+            header = json.loads(f.read(size).decode('utf-8'))
+
+        self.n = header['n']
+        self._entries = {e['name']: e for e in header['cubes']}
+        self._added = {}
+        offset = 16 + size
+        self._channels = self._map(offset, header['channels'])
+        offset += self._channels.nbytes
+        self._cubes = self._map(offset, header['full'])
+
+    def _map(self, offset, shape):
+        'memory-map an array of doubles in the library file'
+        if shape[0] == 0:
+            return np.zeros(shape)
+        return np.memmap(self.filename, dtype='<f8', mode='r', offset=offset, shape=tuple(shape))
+
+    def names(self):
+        'names of the cubes in the library'
+        return list(self._entries)
+
+    def __len__(self):
+        'number of cubes'
+        return len(self._entries)
+
+    def __contains__(self, name):
+        'whether the library has a cube with this name'
+        return name in self._entries
+
+    def _entry(self, name):
+        'description of a cube'
+        if name not in self._entries:
+            raise Exception(f'cube library has no cube named "{name}"')
+        return self._entries[name]
+
+    def _values(self, name):
+        'array of channel outputs or cube values for a cube'
+        if name in self._added:
+            return self._added[name]
+        e = self._entry(name)
+        return self._channels[e['index']] if e['kind'] == 'channels' else self._cubes[e['index']]
+
+    def u_knot(self, name):
+        'knot point coordinates of a cube'
+        return np.array(self._entry(name)['u_knot'])
+
+    def meta(self, name):
+        'metadata of a cube'
+        return dict(self._entry(name)['meta'])
+
+    def cube(self, name):
+        '4D array of RGB values for a cube'
+        values = self._values(name)
+        if self._entry(name)['kind'] == 'channels':
+            return _expandchannels(values)
+        return _readonly(np.array(values))
+
+    def tonemap(self, name):
+        'tonemapping object for a cube; SeparableTonemap if the cube processes the color channels independently, or else TonemapCube'
+        e = self._entry(name)
+        if e['kind'] == 'channels':
+            t = SeparableTonemap()
+            t.u_knot = e['u_knot']
+            t.t_knot = np.array(self._values(name))
+        else:
+            t = TonemapCube()
+            t.u_knot = e['u_knot']
+            t.cube = np.array(self._values(name))
+        return t
+
+    def add(self, name, tonemap, meta=None):
+        'add a cube, from a tonemapping object (e.g., TonemapCube or SeparableTonemap), replacing any cube with the same name; call save() to write it to the library file'
+        if tonemap.u_knot.size != self.n:
+            raise Exception('number of knot points does not match the cubes in the library')
+        t_knot = getattr(tonemap, 't_knot', None)
+        kind = 'full' if t_knot is None else 'channels'
+        self._entries[name] = {'name': name, 'kind': kind, 'index': None, 'u_knot': tonemap.u_knot.tolist(), 'meta': dict(meta or {})}
+        self._added[name] = np.array(tonemap.cube if t_knot is None else t_knot, dtype=float)
+
+    def addfile(self, filename, name=None, meta=None):
+        'add a cube from a cube file; the name is the filename without its directory and extension, if not given'
+        if name is None:
+            name = os.path.splitext(os.path.basename(filename))[0]
+        self.add(name, TonemapCube(filename), meta)
+
+    def remove(self, name):
+        'remove a cube; call save() to remove it from the library file'
+        self._entry(name)
+        del self._entries[name]
+        self._added.pop(name, None)
+
+    def save(self, filename=''):
+        'save library file, with all cubes'
+        if filename:
+            self.filename = filename
+
+        # gather the arrays, in the order of the cubes
+        entries = []
+        values = {'channels': [], 'full': []}
+        for name in self._entries:
+            e = dict(self._entries[name])
+            e['index'] = len(values[e['kind']])
+            values[e['kind']].append(self._values(name))
+            entries.append(e)
+        n = self.n
+        channels = np.stack(values['channels']) if values['channels'] else np.zeros((0, n, 3))
+        cubes = np.stack(values['full']) if values['full'] else np.zeros((0, n, n, n, 3))
+
+        # the arrays above are copies, so release the memory maps of the old file
+        # before replacing it
+        del values
+        self._channels = np.zeros((0, n, 3))
+        self._cubes = np.zeros((0, n, n, n, 3))
+        _writelibrary(self.filename, n, entries, channels, cubes)
+        self.load()
+
+    def fetch(self, name, key, build):
+        'tonemapping object for cube name, if its metadata has the hash key of the inputs it was made from; otherwise call build() to make a new tonemapping object, add it with the hash key, save the library, and return the new object'
+        if name in self and self.meta(name).get('hash') == key:
+            return self.tonemap(name)
+        tonemap = build()
+        self.add(name, tonemap, {'hash': key})
+        self.save()
+        return tonemap
+
+    def export(self, name, filename):
+        'save a cube as a cube file, e.g., for Unity'
+        _writecube(filename, self.cube(name))
+
+    def exportall(self, dirname):
+        'save all cubes as cube files in directory dirname, named after the cubes'
+        os.makedirs(dirname, exist_ok=True)
+        for name in self._entries:
+            self.export(name, os.path.join(dirname, name + '.cube'))
+
+    def __repr__(self):
+        'string representation of object'
+        s = 'cubes = ' + str(self.names()) + '\n'
+        s += 'filename = "' + self.filename + '"\n'
+        return s
+
+def _stackchannels(tonemap):
+    'from a list of tonemapping objects and stacks, return a K x n x 3 array of the channel outputs at the knot points of all their cubes, or None if any cube does not process the color channels independently'
+    if any(t.t_knot is None for t in tonemap):
+        return None
+    return np.concatenate([t.t_knot if isinstance(t, TonemapStack) else t.t_knot[np.newaxis] for t in tonemap])
+
+# class for estimating knot point coordinates by fitting HDRP model predictions to
+# post-processed values from rendering data
+class KnotFit:
+
+    def __init__(self, tonemap, u_hat, v, cubenum=None, i1=2, i2=None, ub=None, dmin=1e-12):
+
+        # tonemapping objects, which share knot points; each must process the
+        # color channels independently, e.g., SeparableTonemap, or TonemapCube with
+        # a cube created by setchannels(), or a TonemapStack of such cubes
+        self.tonemap = tonemap if isinstance(tonemap, (list, tuple)) else [tonemap]
+        self.t_knot = _stackchannels(self.tonemap)                  # K x n x 3 outputs at knot points
+        if self.t_knot is None:
+            raise Exception('knot fitting requires tonemaps that process the color channels independently')
+
+        # data
+        self.u_hat = np.asarray(u_hat, dtype=float)                 # predicted unprocessed values u_k
+        self.v = np.asarray(v, dtype=float)                         # actual post-processed values v_k
+        if cubenum is None:
+            cubenum = np.zeros(self.u_hat.shape[0], dtype=np.intp)
+        self.cubenum = np.asarray(cubenum, dtype=np.intp).reshape((-1,1))  # tonemap used for each sample
+
+        # fit knot points i1 to i2; the knot points on either side of this range
+        # are fixed, and bound the knot points being fitted. if i2 is the last knot
+        # point, the upper bound is ub.
+        self.u_knot = np.array(self.tonemap[0].u_knot, dtype=float)
+        n = self.u_knot.size
+        self.i1 = i1
+        self.i2 = n-1 if i2 is None else i2
+        self.lo = self.u_knot[self.i1-1]
+        self.hi = self.u_knot[self.i2+1] if self.i2 < n-1 else ub
+        if self.hi is None:
+            raise Exception('upper bound ub is required when fitting the last knot point')
+
+        # smallest increment between knot points; see _increments()
+        self.dmin = dmin
+        self.span = self.hi - self.lo - (self.i2 - self.i1 + 2) * dmin
+        if self.span <= 0:
+            raise Exception('range of knot points is too small for the minimum increment dmin')
+
+        # most recent parameters, and residuals and Jacobian found from them
+        self._z = None
+
+    # the knot points being fitted are parameterized by the logarithms z of the
+    # increments between them, from lo to hi, in excess of a minimum increment dmin;
+    # the last increment has log 1, and the increments are normalized so that they
+    # sum to hi-lo. the excess can underflow to zero (e.g., for knot points that the
+    # data hardly constrain), but every increment is still at least dmin, so any z
+    # gives knot points in strictly increasing order between lo and hi, and the fit
+    # is unconstrained.
+
+    @staticmethod
+    def _increments(z):
+        'normalized increments between knot points, from parameters z'
+        # shift the logarithms so that np.exp() doesn't overflow
+        zmax = max(z.max(), 0)
+        e = np.exp(z - zmax)
+        return e / (np.exp(-zmax) + e.sum())
+
+    def z2knots(self, z):
+        'convert parameters to knot points i1 to i2'
+        return self.lo + self.dmin * np.arange(1, z.size+1) + self.span * np.cumsum(self._increments(z))
+
+    def knots2z(self, u):
+        'convert knot points i1 to i2 to parameters'
+        d = np.diff(np.concatenate(((self.lo,), u, (self.hi,)))) - self.dmin
+        if (d <= 0).any():
+            raise Exception('knot points must be increasing by more than dmin, and between their fixed neighbours')
+        return np.log(d[:-1] / d[-1])
+
+    # each residual depends only on the sample's two neighbouring knot points, so the
+    # Jacobian with respect to the knot points has two entries per residual, and is kept
+    # sparse; moving one knot point only changes the residuals of the samples in the
+    # two knot intervals next to it. the residuals aren't binned by knot interval to
+    # update them incrementally, since there are no finite-difference probes to make
+    # cheaper: each iteration moves all the knot points, and needs all the residuals.
+
+    def _evaluate(self, z):
+        'find residuals and their Jacobian for parameters z'
+        from scipy import sparse
+        if self._z is not None and np.array_equal(z, self._z):
+            return
+        u_knot = self.u_knot.copy()
+        u_knot[self.i1:self.i2+1] = self.z2knots(z)
+
+        # predicted tonemapped and post-processed values; linear interpolation
+        # between knot points i and i+1, for each sample and channel
+        i, w = KnotLocator(u_knot).bracket(self.u_hat)
+        ch = np.arange(3)
+        t0 = self.t_knot[self.cubenum, i, ch]
+        dt = self.t_knot[self.cubenum, i+1, ch] - t0
+        t_hat = t0 + w*dt
+        self._r = (srgbinv(t_hat) - self.v).ravel()
+
+        # derivatives of residuals with respect to knot points i and i+1; samples
+        # outside the range of knot points are clipped to the end knot points,
+        # and don't change when the knot points move
+        h = u_knot[i+1] - u_knot[i]
+        inside = (self.u_hat > u_knot[2]) & (self.u_hat < u_knot[-1])
+        g = np.divide(dsrgbinv(t_hat) * dt, h, out=np.zeros(h.shape), where=inside & (h>0))
+        row = np.arange(self._r.size).repeat(2)
+        col = np.stack((i, i+1), axis=-1).ravel()
+        val = np.stack((g*(w-1), -g*w), axis=-1).ravel()
+        Ju = sparse.csr_matrix((val, (row, col)), shape=(self._r.size, u_knot.size))
+        self._Ju = Ju[:, self.i1:self.i2+1]
+
+        # derivatives of knot points with respect to parameters; see _dudz()
+        self._p = self._increments(z)
+        self._c = np.cumsum(self._p)
+        self._z = z.copy()
+
+    # the derivative of knot point a with respect to parameter b is
+    #     span * ( [b<=a] - c[a] ) * p[b]
+    # where p are the increments and c is their cumulative sum. every knot point
+    # depends on every parameter, so this matrix is dense, but it is a triangular
+    # matrix plus a rank-one matrix, and its products with vectors take O(n) time.
+    # the Jacobian of the residuals is the product of the sparse Jacobian with respect
+    # to the knot points, which has two entries for each residual, and this matrix,
+    # so it is applied as a LinearOperator, and is never formed.
+
+    def _dudz(self, x):
+        'product of derivatives of knot points with respect to parameters, and vector x'
+        px = self._p * x
+        return self.span * (np.cumsum(px) - self._c * px.sum())
+
+    def _dudzT(self, y):
+        'product of transpose of derivatives of knot points with respect to parameters, and vector y'
+        return self.span * self._p * (np.cumsum(y[::-1])[::-1] - self._c @ y)
+
+    def residuals(self, z):
+        'residuals of predicted post-processed values v_k, for parameters z'
+        self._evaluate(z)
+        return self._r
+
+    def jacobian(self, z):
+        'Jacobian of residuals with respect to parameters z, as a LinearOperator; see _dudz()'
+        from scipy.sparse.linalg import LinearOperator
+        self._evaluate(z)
+        Ju, dudz, dudzT = self._Ju, self._dudz, self._dudzT
+        return LinearOperator(Ju.shape, dtype=float,
+                              matvec=lambda x: Ju @ dudz(np.ravel(x)),
+                              rmatvec=lambda y: dudzT(Ju.T @ np.ravel(y)))
+
+    def scale(self, z):
+        'norms of the columns of the Jacobian, for parameters z'
+        self._evaluate(z)
+        # JᵀJ = dudzᵀ (JuᵀJu) dudz, where JuᵀJu is a small sparse matrix
+        G = (self._Ju.T @ self._Ju).toarray()
+        D = np.column_stack([self._dudz(e) for e in np.eye(z.size)])
+        return np.sqrt(np.einsum('ij,ik,kj->j', D, G, D))
+
+    def fit(self):
+        'fit knot points i1 to i2, and assign them to the tonemapping objects'
+        from scipy.optimize import least_squares
+        z0 = self.knots2z(self.u_knot[self.i1:self.i2+1])
+        # the Jacobian is a LinearOperator, so the trust-region subproblems are solved
+        # by LSMR, and the parameters are scaled by the column norms of the Jacobian at
+        # the starting point (least_squares can't find them from a LinearOperator)
+        norm = self.scale(z0)
+        x_scale = 1 / np.where(norm > 0, norm, 1)
+        r = least_squares(self.residuals, z0, jac=self.jacobian, tr_solver='lsmr', x_scale=x_scale)
+        self.u_knot[self.i1:self.i2+1] = self.z2knots(r.x)
+        for t in self.tonemap:
+            t.u_knot = self.u_knot.copy()
+        return r
+
+def _segmentfit(g, x, t, k, ngroup):
+    'least-squares lines t = a + b*x fitted separately to the samples in each group g, using only samples where k is True; returns a, b, and the number of samples in each group'
+    w = k.astype(float)
+    N = np.bincount(g, weights=w, minlength=ngroup)
+    Sx = np.bincount(g, weights=w*x, minlength=ngroup)
+    St = np.bincount(g, weights=w*t, minlength=ngroup)
+    Sxx = np.bincount(g, weights=w*x*x, minlength=ngroup)
+    Sxt = np.bincount(g, weights=w*x*t, minlength=ngroup)
+    d = N*Sxx - Sx*Sx
+    b = np.divide(N*Sxt - Sx*St, d, out=np.full(ngroup, np.nan), where=(N >= 2) & (d > 0))
+    a = np.divide(St - b*Sx, N, out=np.full(ngroup, np.nan), where=N >= 2)
+    return a, b, N
+
+def deltaknots(delta_m, u_k, t_k, lo=2, refine=False, tmin=0.05, returnorder=False):
+    'estimate knot points from tonemapped values t_k at unprocessed values u_k, rendered with cube files that are delta functions at knot points delta_m (counting from 1); if refine is True, the knot points are refined to sub-sample precision; returns an array of knot points, with nan for knot points below lo (counting from 0) or with no data, and if returnorder is True, also the indices that sort the samples by delta_m and u_k'
+
+    # with the delta function at knot point m, the tonemapping function is a
+    # triangle that peaks at knot point m; for the lowest knot point (lo), it is
+    # one for values below the knot point, and for the highest knot point, it is
+    # one for values above it, since the cube clips values to the range of the
+    # knot points. we sort the samples once by cube and u_k, and find the knot
+    # point for each cube with reductions over the segments of the sorted arrays.
+    delta_m = np.asarray(delta_m, dtype=np.intp)
+    order = np.lexsort((u_k, delta_m))
+    m = delta_m[order]
+    u = np.asarray(u_k, dtype=float)[order]
+    t = np.asarray(t_k, dtype=float)[order]
+    start = np.flatnonzero(np.concatenate(((True,), m[1:] != m[:-1])))
+    count = np.diff(np.append(start, m.size))
+    group = m[start]                    # knot point number (counting from 1) for each segment
+    g = np.repeat(np.arange(start.size), count)
+    idx = np.arange(m.size)
+    n = group.max()
+    first = group == lo+1
+    last = group == n
+
+    # sample at the peak of the triangle; for the lowest knot point, the last
+    # sample where t_k is close to one, and for the highest knot point, the first
+    # sample where t_k is one
+    tmax = np.maximum.reduceat(t, start)
+    peak = np.minimum.reduceat(np.where(t == tmax[g], idx, m.size), start)
+    peak[first] = np.maximum.reduceat(np.where(t > 0.99, idx, -1), start)[first]
+    peak[last] = np.minimum.reduceat(np.where(t == 1, idx, m.size), start)[last]
+    found = (peak >= start) & (peak < start + count)
+    peak[~found] = start[~found]
+    upeak = u[peak]
+
+    # refine the knot point by fitting lines to the rising and falling sides of
+    # the triangle, and finding where they intersect each other, or for the
+    # lowest and highest knot points, where they reach one. u_k is measured from
+    # the peak sample in each segment, so that the fits are well conditioned.
+    shift = np.zeros(start.size)
+    if refine:
+        x = u - upeak[g]
+        k = t > tmin
+        a1, b1, _ = _segmentfit(g, x, t, k & (idx < peak[g]), start.size)
+        a2, b2, _ = _segmentfit(g, x, t, k & (idx > peak[g]), start.size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xpeak = (a2 - a1) / (b1 - b2)
+            xpeak[first] = ((1 - a2) / b2)[first]
+            xpeak[last] = ((1 - a1) / b1)[last]
+        xpeak[first & ~(b2 < 0)] = np.nan
+        xpeak[last & ~(b1 > 0)] = np.nan
+        xpeak[~first & ~last & ~((b1 > 0) & (b2 < 0))] = np.nan
+
+        # keep the refined knot point only if it is between the samples on
+        # either side of the peak sample
+        xlo = u[np.maximum(peak-1, start)] - upeak
+        xhi = u[np.minimum(peak+1, start+count-1)] - upeak
+        ok = (xpeak >= xlo) & (xpeak <= xhi)
+        shift[ok] = xpeak[ok]
+
+    u_knot = np.full(n, np.nan)
+    keep = found & (group > lo)
+    u_knot[group[keep]-1] = upeak[keep] + shift[keep]
+    if returnorder:
+        return u_knot, order
+    return u_knot
+
+# columns of the data files written by Unity project render_random, in the order
+# that they are stored in RenderDataset
+_columns = ('e', 'm_r', 'm_g', 'm_b', 'd_r', 'd_g', 'd_b', 'a_r', 'a_g', 'a_b', 'v_r', 'v_g', 'v_b', 'i_d', 'i_a', 'l_x', 'l_y', 'l_z', 'n_x', 'n_y', 'n_z')
+
+def _field(r1, r2, doc):
+    'property that returns rows r1 to r2-1 of a RenderDataset, as an m x (r2-r1) view'
+    return property(lambda self: self.data[r1:r2].T, doc=doc)
+
+# class for rendering data generated by Unity project render_random. the model
+# parameters for all samples are stored as rows of a single 2D array, and the
+# fields (e, m, d, ...) are views into it, so no copies are made when the fields
+# are used. subsets of samples for one cube file are views as well, and subsets
+# selected by a mask are made with one pass over the data, instead of one per field.
+class RenderDataset:
+
+    e = _field(0, 1, 'exposure')
+    m = _field(1, 4, 'material color')
+    d = _field(4, 7, 'directional light color')
+    a = _field(7, 10, 'ambient light color')
+    v = _field(10, 13, 'post-processed color')
+    i_d = _field(13, 14, 'directional light intensity')
+    i_a = _field(14, 15, 'ambient light intensity')
+    l = _field(15, 18, 'lighting direction')
+    n = _field(18, 21, 'plane surface normal')
+    costheta = _field(21, 22, 'cosine of angle between lighting direction and plane surface normal')
+
+    def __init__(self, data, cubenum=None):
+
+        # 22 x m array of model parameters; one column for each sample
+        self.data = data
+
+        # number of cube file used for each sample
+        if cubenum is None:
+            cubenum = np.zeros(data.shape[1], dtype=np.intp)
+        self.cubenum = cubenum
+
+        # if samples are sorted by cube file, then subsets for one cube file are views
+        self._sorted = bool((np.diff(cubenum) >= 0).all())
+
+    @classmethod
+    def load(cls, fname, cubenum=0):
+        'load data file generated by render_random; cubenum is the number of the cube file used'
+        from renderlog import readlog
+        return cls.fromcolumns(readlog(fname), cubenum)
+
+    @classmethod
+    def fromcolumns(cls, cols, cubenum=0):
+        'create dataset from a mapping of column names (see _columns) to arrays, e.g., from readlog() or a pandas DataFrame'
+        m = cols['e'].size
+        data = np.empty((len(_columns)+1, m))
+        for r, col in enumerate(_columns):
+            data[r] = cols[col]
+        costheta = data[21]
+        np.multiply(data[15], data[18], out=costheta)
+        costheta += data[16] * data[19]
+        costheta += data[17] * data[20]
+        return cls(data, np.full(m, cubenum, dtype=np.intp))
+
+    @classmethod
+    def concat(cls, datasets):
+        'concatenate datasets, e.g., for several cube files'
+        data = np.concatenate([d.data for d in datasets], axis=1)
+        cubenum = np.concatenate([d.cubenum for d in datasets])
+        return cls(data, cubenum)
+
+    def render(self, c=1.0, lambertian=True, out=None, dtype=None, chunksize=16384):
+        'apply rendering model to find unprocessed color coordinates u_k; see rendermodel()'
+        return rendermodel(self.m, self.d, self.a, self.i_d, self.i_a, self.costheta, self.e, c=c, lambertian=lambertian, out=out, dtype=dtype, chunksize=chunksize)
+
+    def where(self, k):
+        'subset of samples selected by boolean mask or index array k'
+        k = np.flatnonzero(k) if np.asarray(k).dtype == bool else k
+        return RenderDataset(self.data.take(k, axis=1), self.cubenum[k])
+
+    def cube(self, i):
+        'subset of samples for cube file i; a view if samples are sorted by cube file'
+        if not self._sorted:
+            return self.where(self.cubenum == i)
+        a, b = np.searchsorted(self.cubenum, (i, i+1))
+        return RenderDataset(self.data[:, a:b], self.cubenum[a:b])
+
+    def __len__(self):
+        'number of samples'
+        return self.data.shape[1]
+
+    def __repr__(self):
+        'string representation of object'
+        s = 'samples = ' + str(len(self)) + '\n'
+        s += 'cubes = ' + str(np.unique(self.cubenum)) + '\n'
+        return s
+
+class _HashReader:
+    'file wrapper that finds the SHA-1 hash of the bytes that are read through it'
+
+    def __init__(self, f):
+        self.f = f
+        self.h = hashlib.sha1()
+
+    def read(self, size=-1):
+        'read bytes from the file, and add them to the hash'
+        b = self.f.read(size)
+        self.h.update(b)
+        return b
+
+    def hexdigest(self):
+        'hash of the bytes read so far'
+        return self.h.hexdigest()
+
+def _filesums(n, suu, suh, shh, hist):
+    'sums and histogram counts from a data file, as a dict that can be saved as JSON; only the nonzero bins of the histogram are kept'
+    bins = np.flatnonzero(hist)
+    return {'n': int(n), 'suu': float(suu), 'suh': float(suh), 'shh': float(shh),
+            'bins': bins.tolist(), 'counts': hist[bins].tolist()}
+
+def _unpacksums(part, nbin):
+    'sums and histogram counts from a dict made by _filesums()'
+    hist = np.zeros(nbin, dtype=np.int64)
+    hist[part['bins']] = part['counts']
+    return part['n'], part['suu'], part['suh'], part['shh'], hist
+
+# class for estimating the rendering scale constant c in a single pass over any
+# number of data files, with memory that doesn't depend on the amount of data. the
+# regression slope of predicted rendered values u_hat (without c) against actual
+# values u, for a line through the origin, is sum(u*u_hat)/sum(u**2), and c is its
+# inverse, so we only need to keep running sums. for a robust estimate, we also keep
+# a histogram of log2(u_hat/u), which gives the median ratio. the state can be saved
+# and loaded, so that data files can be added as they arrive; files that have already
+# been added (by SHA-1 hash) are skipped. the sums and the histogram counts from each
+# data file are also kept, by hash, so that when two estimators that have added some
+# of the same files are merged, those files are only counted once.
+class ScaleEstimator:
+
+    def __init__(self, lo=0, hi=0.95, rmin=0.05, nbin=8000, rrange=4):
+
+        # samples are used if u and u_hat are in [ lo, hi ], and samples are
+        # added to the histogram of ratios if u is also at least rmin
+        self.lo = lo
+        self.hi = hi
+        self.rmin = rmin
+
+        # histogram of log2(u_hat/u), with nbin bins over [ -rrange, rrange ]
+        self.rrange = rrange
+        self.hist = np.zeros(nbin, dtype=np.int64)
+
+        # running sums
+        self.n = 0          # number of samples
+        self.suu = 0.0      # sum of u**2
+        self.suh = 0.0      # sum of u*u_hat
+        self.shh = 0.0      # sum of u_hat**2
+
+        # sums and histogram counts from each data file that has been added, by
+        # SHA-1 hash of the file; each is a dict with n, suu, suh, shh, and the
+        # nonzero bins of the histogram and their counts
+        self.files = {}
+
+    def _sums(self, u, u_hat):
+        'sums and histogram counts for samples u and u_hat'
+        u = np.asarray(u, dtype=float).ravel()
+        u_hat = np.asarray(u_hat, dtype=float).ravel()
+        k = (u >= self.lo) & (u <= self.hi) & (u_hat >= self.lo) & (u_hat <= self.hi)
+        u = u[k]
+        u_hat = u_hat[k]
+
+        k = (u >= self.rmin) & (u_hat > 0)
+        r = np.log2(u_hat[k] / u[k])
+        nbin = self.hist.size
+        b = ((r + self.rrange) * (nbin / (2*self.rrange))).astype(np.intp).clip(0, nbin-1)
+        return u.size, np.dot(u, u), np.dot(u, u_hat), np.dot(u_hat, u_hat), np.bincount(b, minlength=nbin)
+
+    def _add(self, n, suu, suh, shh, hist, sign=1):
+        'add (or, with sign = -1, subtract) sums and histogram counts'
+        self.n += sign * n
+        self.suu += sign * suu
+        self.suh += sign * suh
+        self.shh += sign * shh
+        self.hist += sign * hist
+
+    def update(self, u, u_hat):
+        'add samples of actual rendered values u, and predicted values u_hat without scale constant c'
+        self._add(*self._sums(u, u_hat))
+
+    def addlog(self, fname, chunksize=65536):
+        'add samples from a data file generated by render_random with a Lambertian material and no tonemapping; returns False if the file has already been added'
+        import pandas as pd
+
+        # the file is read once, in chunks of chunksize rows, and its hash is found
+        # from the same bytes as they are read, so memory doesn't depend on the size
+        # of the file. the sums for the file are kept apart until the end, so that
+        # they can be discarded if the file turns out to have been added already.
+        n, suu, suh, shh, hist = 0, 0.0, 0.0, 0.0, np.zeros(self.hist.size, dtype=np.int64)
+        with open(fname, 'rb') as f:
+            reader = _HashReader(f)
+            for df in pd.read_csv(reader, usecols=_columns, chunksize=chunksize):
+                data = RenderDataset.fromcolumns(df)
+                dn, duu, duh, dhh, dhist = self._sums(srgb(data.v, quantized=True), data.render())
+                n, suu, suh, shh = n + dn, suu + duu, suh + duh, shh + dhh
+                hist += dhist
+            reader.read()   # hash any bytes the parser didn't need
+        h = reader.hexdigest()
+
+        if h in self.files:
+            return False
+        self._add(n, suu, suh, shh, hist)
+        self.files[h] = _filesums(n, suu, suh, shh, hist)
+        return True
+
+    def merge(self, other):
+        'add the samples of another estimator, e.g., from another process; data files that both estimators have added are only counted once'
+        if other.hist.size != self.hist.size or other.rrange != self.rrange:
+            raise Exception('histograms of estimators do not match')
+        if (other.lo, other.hi, other.rmin) != (self.lo, self.hi, self.rmin):
+            raise Exception('sample ranges of estimators do not match')
+        self._add(other.n, other.suu, other.suh, other.shh, other.hist)
+        for h, part in other.files.items():
+            if h in self.files:
+                self._add(*_unpacksums(part, self.hist.size), sign=-1)
+            else:
+                self.files[h] = dict(part)
+
+    @property
+    def slope(self):
+        'regression slope of u_hat against u, for a line through the origin'
+        return self.suh / self.suu
+
+    @property
+    def c(self):
+        'rendering scale constant; inverse of the regression slope'
+        return self.suu / self.suh
+
+    @property
+    def rms(self):
+        'root-mean-square residual of u_hat from the regression line'
+        m = self.slope
+        return np.sqrt(max(self.shh - 2*m*self.suh + m*m*self.suu, 0) / self.n)
+
+    @property
+    def crobust(self):
+        'robust estimate of the rendering scale constant; inverse of the median ratio u_hat/u'
+        cum = np.cumsum(self.hist)
+        if cum[-1] == 0:
+            return np.nan
+        b = np.searchsorted(cum, cum[-1] / 2)
+        # interpolate within the bin that contains the median
+        below = cum[b-1] if b > 0 else 0
+        f = (cum[-1] / 2 - below) / self.hist[b]
+        w = 2*self.rrange / self.hist.size
+        return 2 ** -(-self.rrange + (b + f) * w)
+
+    def save(self, fname):
+        'save the state of the estimator'
+        state = {'lo': self.lo, 'hi': self.hi, 'rmin': self.rmin, 'rrange': self.rrange,
+                 'n': self.n, 'suu': self.suu, 'suh': self.suh, 'shh': self.shh,
+                 'files': self.files, 'hist': self.hist.tolist()}
+        tmpname = fname + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmpname, fname)
+
+    @classmethod
+    def load(cls, fname):
+        'load the state of an estimator saved by save()'
+        with open(fname, 'r') as f:
+            state = json.load(f)
+        est = cls(state['lo'], state['hi'], state['rmin'], len(state['hist']), state['rrange'])
+        est.n, est.suu, est.suh, est.shh = state['n'], state['suu'], state['suh'], state['shh']
+        est.files = dict(state['files'])
+        est.hist = np.array(state['hist'], dtype=np.int64)
+        return est
+
+    def __repr__(self):
+        'string representation of object'
+        s = 'samples = ' + str(self.n) + '\n'
+        s += 'files = ' + str(len(self.files)) + '\n'
+        s += f'c = {self.c:.4f}\n' if self.n else ''
+        s += f'crobust = {self.crobust:.4f}\n' if self.n else ''
+        return s
@@ -0,0 +1,106 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+# the text data files written by the Unity projects (e.g., data_L1_T0.txt from
+# render_random, and data_delta.txt from render_delta) are parsed once, and their
+# columns are saved as .npy files in a cache directory next to the data file, e.g.,
+# data/data_L1_T0.cache/. later calls to readlog() load the columns from the cache,
+# memory-mapped, with no parsing. the cache is keyed by the size, modification time,
+# and SHA-1 hash of the data file, and is rebuilt when the data file changes.
+#
+# the .npy files are never written in place, since other processes (or earlier calls
+# in this one) may have them memory-mapped. each build writes the columns to a new
+# temporary directory, renames it to a directory named for the hash of the data file
+# (e.g., data/data_L1_T0.cache/columns-3f2a.../), and only then switches meta.json to
+# point to it. directories left over from earlier versions of the data file are then
+# removed, if they aren't in use (on Windows, a file can't be removed while it's
+# mapped; such directories are removed by a later build).
+
+def cachedir(fname):
+    'directory where the columns of data file fname are cached'
+    return os.path.splitext(fname)[0] + '.cache'
+
+def filehash(fname, blocksize=1 << 20):
+    'SHA-1 hash of a file'
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def _readmeta(dname):
+    'read the description of a cache directory, or return None if there is none'
+    try:
+        with open(os.path.join(dname, 'meta.json'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _writemeta(dname, meta):
+    'write the description of a cache directory'
+    fd, tmpname = tempfile.mkstemp(prefix='meta-', suffix='.tmp', dir=dname)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmpname, os.path.join(dname, 'meta.json'))
+
+def _build(fname, dname, st):
+    'parse data file fname, and save its columns in cache directory dname'
+    import pandas as pd
+    sha1 = filehash(fname)
+    df = pd.read_csv(fname)
+    os.makedirs(dname, exist_ok=True)
+
+    # write the columns to a new directory; if another process has already made the
+    # directory for this version of the data file, use that one instead
+    coldir = 'columns-' + sha1
+    tmpdir = tempfile.mkdtemp(prefix='columns-', suffix='.tmp', dir=dname)
+    for col in df.columns:
+        np.save(os.path.join(tmpdir, col + '.npy'), np.ascontiguousarray(df[col].to_numpy()))
+    try:
+        os.rename(tmpdir, os.path.join(dname, coldir))
+    except OSError:
+        if not os.path.isdir(os.path.join(dname, coldir)):
+            raise
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    meta = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha1': sha1, 'dir': coldir, 'columns': list(df.columns)}
+    _writemeta(dname, meta)
+
+    # remove directories from earlier versions
+    for entry in os.listdir(dname):
+        if entry.startswith('columns-') and entry != coldir and not entry.endswith('.tmp'):
+            shutil.rmtree(os.path.join(dname, entry), ignore_errors=True)
+    return meta
+
+def _load(dname, meta):
+    'load the columns listed in the description of a cache directory, memory-mapped'
+    coldir = os.path.join(dname, meta['dir'])
+    return {col: np.load(os.path.join(coldir, col + '.npy'), mmap_mode='r') for col in meta['columns']}
+
+def readlog(fname):
+    'read a data file written by a Unity project; return a dict of its columns, as memory-mapped arrays'
+    st = os.stat(fname)
+    dname = cachedir(fname)
+    meta = _readmeta(dname)
+
+    # check whether the cache is up to date; if the size matches but the modification
+    # time doesn't (e.g., the file was copied), compare hashes before rebuilding
+    if meta is None or 'dir' not in meta or meta['size'] != st.st_size:
+        meta = _build(fname, dname, st)
+    elif meta['mtime_ns'] != st.st_mtime_ns:
+        if filehash(fname) == meta['sha1']:
+            meta['mtime_ns'] = st.st_mtime_ns
+            _writemeta(dname, meta)
+        else:
+            meta = _build(fname, dname, st)
+
+    # if another process rebuilt the cache for a different version of the data file
+    # after we read meta.json, our version may have been removed; rebuild it
+    try:
+        return _load(dname, meta)
+    except FileNotFoundError:
+        return _load(dname, _build(fname, dname, st))
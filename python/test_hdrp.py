@@ -0,0 +1,45 @@
+# test_hdrp.py  Tests for hdrp.py; run with pytest
+
+import numpy as np
+from hdrp import srgb, srgbinv
+
+def test_quantized_srgb_above_one():
+    # with maxout=False, the table lookup should agree with the formula for inputs above 1
+    x = np.array([0, 1, 128, 255, 300, 510]) / 255
+    for f in (srgb, srgbinv):
+        assert np.allclose(f(x, quantized=True, maxout=False), f(x, maxout=False))
+        assert np.allclose(f(x, quantized=True), f(x))
+        y = x.copy()
+        f(y, quantized=True, maxout=False, out=y)
+        assert np.allclose(y, f(x, maxout=False))
+
+def _writelog(fname, rows, seed):
+    'write a small random data file in the format of render_random'
+    from hdrp import _columns
+    rng = np.random.default_rng(seed)
+    data = rng.uniform(0, 1, (rows, len(_columns)))
+    data[:, _columns.index('e')] = 0
+    v = [_columns.index('v_' + ch) for ch in 'rgb']
+    data[:, v] = np.rint(data[:, v] * 255) / 255
+    np.savetxt(fname, data, delimiter=',', header=','.join(_columns), comments='', fmt='%.6f')
+
+def test_scale_estimator_merge_shared_file(tmp_path):
+    # merging estimators that have both added the same file should count it once
+    from hdrp import ScaleEstimator
+    f1, f2 = str(tmp_path / 'log1.txt'), str(tmp_path / 'log2.txt')
+    _writelog(f1, 500, 1)
+    _writelog(f2, 300, 2)
+    a = ScaleEstimator()
+    a.addlog(f1)
+    b = ScaleEstimator()
+    b.addlog(f1, chunksize=64)
+    b.addlog(f2)
+    both = ScaleEstimator()
+    both.addlog(f1)
+    both.addlog(f2)
+    a.merge(b)
+    assert a.n == both.n
+    assert np.isclose(a.c, both.c)
+    assert (a.hist == both.hist).all()
+    assert sorted(a.files) == sorted(both.files)
+    assert not a.addlog(f2)